@@ -0,0 +1,147 @@
+"""Compare cost of parsing debug_token responses.
+
+Usage: python benchmarks/parse_facebook_response.py [repetitions]
+
+The former TokenInformationForm based parser is kept here for comparison.
+Both parsers are checked to give the same results before timing.
+"""
+import copy
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import django
+from django import forms as django_forms
+from django.conf import settings
+from django.utils import timezone
+
+if not settings.configured:
+    settings.configure(USE_TZ=True)
+    django.setup()
+
+from facebook_auth import forms
+
+
+class ListField(django_forms.MultiValueField):
+    def clean(self, value):
+        if hasattr(value, '__len__'):
+            self.fields = [django_forms.CharField(required=False)
+                           for _ in range(len(value))]
+        return super(ListField, self).clean(value)
+
+    def compress(self, data_list):
+        return data_list
+
+
+class TokenInformationForm(django_forms.Form):
+    user_id = django_forms.CharField()
+    token = django_forms.CharField()
+    expires_at = django_forms.CharField()
+    token_is_valid = django_forms.BooleanField()
+    scopes = ListField(required=False)
+
+    def __init__(self, initial, *args, **kwargs):
+        super(TokenInformationForm, self).__init__(initial, *args, **kwargs)
+        initial['token_is_valid'] = initial.get('is_valid', False)
+
+    def clean_token_is_valid(self):
+        if 'token_is_valid' not in self.cleaned_data:
+            raise django_forms.ValidationError('No token status in response.')
+        is_valid = self.cleaned_data['token_is_valid']
+        if not is_valid:
+            raise django_forms.ValidationError('Token is invalid.')
+        return is_valid
+
+    def clean_expires_at(self):
+        timestamp = self.data['expires_at']
+        naive = datetime.fromtimestamp(int(timestamp))
+        return naive.replace(tzinfo=timezone.utc)
+
+
+def try_to_parse_facebook_response_with_form(raw_response, token):
+    forms._get_response_data(raw_response)
+    data = copy.deepcopy(raw_response.get('data', {}))
+    data['token'] = token
+    form = TokenInformationForm(data)
+    if form.is_valid():
+        return forms.ParsedResponse(form.cleaned_data, True, None)
+    else:
+        raise forms.FacebookResponseError(form.errors)
+
+
+RESPONSES = {
+    'valid': {'data': {
+        'expires_at': 1403429380,
+        'scopes': ['public_profile', 'email', 'user_friends',
+                   'publish_actions'],
+        'app_id': 423260947733647,
+        'application': 'Social WiFi',
+        'issued_at': 1398245380,
+        'is_valid': True,
+        'user_id': 1000066666,
+    }},
+    'invalid': {'data': {
+        'error': {'code': 190, 'message': 'Error validating access token'},
+        'is_valid': False,
+        'scopes': [],
+    }},
+}
+
+COMPATIBILITY_RESPONSES = [
+    {'data': {'expires_at': 12341234, 'is_valid': True,
+              'scopes': ['email', None], 'user_id': 123}},
+    {'data': {'expires_at': '12341234', 'is_valid': 'foo',
+              'user_id': '123'}},
+    {'data': {'expires_at': 12341234, 'is_valid': 'false',
+              'user_id': '123'}},
+    {'data': {'expires_at': 0, 'is_valid': True, 'user_id': 1.1,
+              'scopes': {}}},
+    {'data': {'expires_at': 12341234, 'is_valid': True,
+              'scopes': 'email', 'user_id': '123'}},
+    {'data': {'expires_at': 12341234, 'is_valid': True,
+              'scopes': ['', None], 'user_id': '123'}},
+    {'data': {'expires_at': {}, 'is_valid': [], 'user_id': ''}},
+]
+
+PARSERS = (
+    ('form', try_to_parse_facebook_response_with_form),
+    ('fast', forms.try_to_parse_facebook_response),
+)
+
+
+def parse(parser, response):
+    try:
+        parser(response, 'token')
+    except forms.FacebookResponseError:
+        pass
+
+
+def get_result(parser, response):
+    try:
+        return parser(response, '123').parsed_data, None
+    except forms.FacebookResponseError as e:
+        return None, sorted(e.errors)
+
+
+def check_compatibility():
+    for response in list(RESPONSES.values()) + COMPATIBILITY_RESPONSES:
+        results = [get_result(parser, response) for _, parser in PARSERS]
+        if results[0] != results[1]:
+            sys.exit('Parsers differ for %r: %r' % (response, results))
+
+
+def main(repetitions):
+    check_compatibility()
+    for name, response in sorted(RESPONSES.items()):
+        for parser_name, parser in PARSERS:
+            seconds = min(timeit.repeat(
+                lambda: parse(parser, response), number=repetitions, repeat=3))
+            print('%-8s %-5s %8.2f us/response' % (
+                name, parser_name, seconds / repetitions * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,275 @@
+"""Benchmark token storage and lookup hot paths.
+
+Examples::
+
+    python benchmarks/token_storage.py --tokens 10000
+    python benchmarks/token_storage.py --database postgres \\
+        --db-name facebook_auth-benchmark --tokens 1000000 \\
+        --save-baseline baseline.json
+    python benchmarks/token_storage.py --compare baseline.json
+
+Graph API is stubbed, so no requests leave the machine. Data is inserted
+once per database; pass --reset to repopulate it. Every operation runs in a
+transaction which is rolled back, so runs measure the same data.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+import timeit
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+OPERATIONS = (
+    'get_access_token',
+    'insert_token',
+    'invalidate_access_token',
+    'product_user',
+    'update_app_friends',
+    'debug_all_tokens_for_user',
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', choices=['sqlite', 'postgres'],
+                        default='sqlite')
+    parser.add_argument('--db-name', default='facebook_auth-benchmark')
+    parser.add_argument('--tokens', type=int, default=10000)
+    parser.add_argument('--tokens-per-user', type=int, default=3)
+    parser.add_argument('--friends', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS,
+                        default=list(OPERATIONS))
+    parser.add_argument('--reset', action='store_true')
+    parser.add_argument('--save-baseline')
+    parser.add_argument('--compare')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed relative slowdown of p50 latency.')
+    return parser.parse_args()
+
+
+def configure(args):
+    import django
+    from django.conf import settings
+    if args.database == 'postgres':
+        database = {'ENGINE': 'django.db.backends.postgresql_psycopg2',
+                    'NAME': args.db_name}
+    else:
+        database = {'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': '%s.sqlite3' % args.db_name}
+    settings.configure(
+        DATABASES={'default': database},
+        USE_TZ=True,
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'facebook_auth',
+        ),
+        FACEBOOK_APP_ID='1',
+        FACEBOOK_APP_SECRET='secret',
+        FACEBOOK_API_VERSION='2.1',
+    )
+    django.setup()
+
+
+def populate(args):
+    from django.core.management import call_command
+    from django.utils import timezone
+    from facebook_auth import models
+
+    call_command('migrate', verbosity=0)
+    if args.reset:
+        models.UserToken.objects.all().delete()
+        models.FacebookUser.objects.all().delete()
+    if models.UserToken.objects.exists():
+        return
+    sys.stdout.write('Inserting %d tokens...\n' % args.tokens)
+    now = timezone.now()
+    batch = []
+    for i in range(args.tokens):
+        batch.append(models.UserToken(
+            provider_user_id=str(i // args.tokens_per_user),
+            token='token-%d' % i,
+            expiration_date=now + datetime.timedelta(days=i % 60)))
+        if len(batch) == 5000:
+            models.UserToken.objects.bulk_create(batch)
+            batch = []
+    models.UserToken.objects.bulk_create(batch)
+    for i in range(args.friends):
+        models.FacebookUser.objects.create(user_id=i, username=str(i))
+
+
+class StubGraph(object):
+    def get(self, path, input_token=None, **params):
+        return self.debug_response(input_token)
+
+    def batch(self, requests):
+        return [self.debug_response(None) for _ in requests]
+
+    @staticmethod
+    def debug_response(token):
+        return {'data': {
+            'user_id': '0', 'is_valid': True, 'scopes': ['email'],
+            'expires_at': int(time.time()) + 3600,
+        }}
+
+
+def build_operations(args):
+    """Return operations as (setup, run) pairs.
+
+    Only run(*setup()) is measured.
+    """
+    from facebook_auth import backends
+    from facebook_auth import models
+
+    users = max(1, args.tokens // args.tokens_per_user)
+    facebook_users = list(models.FacebookUser.objects.all())
+    counter = [0]
+
+    def random_user():
+        return str(random.randrange(users))
+
+    def new_token():
+        counter[0] += 1
+        return 'benchmark-%d-%d' % (os.getpid(), counter[0])
+
+    def insert_token():
+        models.UserTokenManager.insert_token(random_user(), new_token())
+
+    def invalidate_access_token():
+        token = 'token-%d' % random.randrange(args.tokens)
+        models.UserTokenManager.invalidate_access_token(token)
+
+    def product_user():
+        user_id = random.randrange(args.friends)
+        profile = {'id': str(user_id), 'first_name': 'First',
+                   'last_name': 'Last', 'email': 'user@example.com'}
+        backends.UserFactory()._product_user(new_token(), profile)
+
+    def pick_friends():
+        user = random.choice(facebook_users)
+        friends = random.sample(range(args.friends), args.friends // 2)
+        user.iter_friends = lambda **kwargs: [{'id': str(f)}
+                                              for f in friends]
+        return (user,)
+
+    def update_app_friends(user):
+        user.update_app_friends()
+
+    def debug_all_tokens_for_user():
+        models.debug_all_tokens_for_user(random_user())
+
+    def get_access_token():
+        try:
+            models.UserTokenManager.get_access_token(random_user())
+        except models.UserToken.DoesNotExist:
+            pass
+
+    def no_setup():
+        return ()
+
+    return {
+        'get_access_token': (no_setup, get_access_token),
+        'insert_token': (no_setup, insert_token),
+        'invalidate_access_token': (no_setup, invalidate_access_token),
+        'product_user': (no_setup, product_user),
+        'update_app_friends': (pick_friends, update_app_friends),
+        'debug_all_tokens_for_user': (no_setup, debug_all_tokens_for_user),
+    }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(operation, repeat):
+    from django.db import connection
+    from django.db import transaction
+    from django.test.utils import CaptureQueriesContext
+
+    setup, run = operation
+    latencies = []
+    queries = 0
+    random.seed(0)
+    with transaction.atomic():
+        for _ in range(repeat):
+            args = setup()
+            with CaptureQueriesContext(connection) as context:
+                start = timeit.default_timer()
+                run(*args)
+                latencies.append((timeit.default_timer() - start) * 1000)
+            queries += len(context)
+        transaction.set_rollback(True)
+    return {
+        'queries': float(queries) / repeat,
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if result['queries'] > old['queries']:
+            regressions.append('%s: %.1f queries/op, was %.1f' % (
+                name, result['queries'], old['queries']))
+        if result['p50'] > old['p50'] * (1 + threshold):
+            regressions.append('%s: p50 %.3f ms, was %.3f ms' % (
+                name, result['p50'], old['p50']))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    configure(args)
+    populate(args)
+
+    from facebook_auth import models
+    patches = [
+        mock.patch.object(models.FacebookTokenManager,
+                          'debug_all_user_tokens'),
+        mock.patch('facebook_auth.utils.get_application_graph',
+                   return_value=StubGraph()),
+        mock.patch.object(models.debug_all_tokens_for_user, 'retry'),
+    ]
+    for patch in patches:
+        patch.start()
+
+    operations = build_operations(args)
+    results = {}
+    sys.stdout.write('%-26s %9s %9s %9s %9s\n' % (
+        'operation', 'queries', 'p50 ms', 'p90 ms', 'p99 ms'))
+    for name in args.operations:
+        results[name] = result = measure(operations[name], args.repeat)
+        sys.stdout.write('%-26s %9.1f %9.3f %9.3f %9.3f\n' % (
+            name, result['queries'], result['p50'], result['p90'],
+            result['p99']))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            sys.stdout.write('REGRESSION %s\n' % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Asyncio counterparts of Graph API helpers from facebook_auth.utils.
+
+Requires Python 3.5+ and aiohttp.
+"""
+import asyncio
+import time
+
+import facepy
+from django.conf import settings
+
+from facebook_auth import utils
+from facebook_auth.facepy_wrapper import async_graph_api
+from facebook_auth.facepy_wrapper import metrics
+
+
+async def get_from_graph_api(graphAPI, query, retry_policy=None, **params):
+    retry_policy = retry_policy or utils.DEFAULT_RETRY_POLICY
+    start = time.time()
+    attempt = 0
+    while True:
+        try:
+            return await graphAPI.get(query, **params)
+        except facepy.FacepyError as e:
+            response = getattr(graphAPI, 'last_response', None)
+            delay = retry_policy.get_retry_delay(
+                attempt, e, time.time() - start,
+                getattr(response, 'headers', None))
+            if delay is None:
+                raise
+            metrics.REGISTRY.record_retry(metrics.normalize_endpoint(query),
+                                          getattr(e, 'code', None))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def get_graph(*args, **kwargs):
+    return async_graph_api.get_graph(*args, version=utils.FACEBOOK_API_VERSION,
+                                     timeout=utils.FACEBOOK_TIMEOUT, **kwargs)
+
+
+async def get_application_graph(version=None, session=None):
+    loop = asyncio.get_event_loop()
+    token = await loop.run_in_executor(
+        None, utils.get_application_access_token, version)
+    return get_graph(token, session=session)
+
+
+async def get_long_lived_access_token(access_token, session=None):
+    return await async_graph_api.get_long_lived_access_token(
+        access_token=access_token,
+        client_id=settings.FACEBOOK_APP_ID,
+        client_secret=settings.FACEBOOK_APP_SECRET,
+        session=session,
+    )
+
+
+async def get_access_token(code=None, redirect_uri=None, session=None):
+    return await async_graph_api.get_access_token(
+        code=code,
+        redirect_uri=redirect_uri,
+        client_id=settings.FACEBOOK_APP_ID,
+        client_secret=settings.FACEBOOK_APP_SECRET,
+        timeout=utils.FACEBOOK_TIMEOUT,
+        session=session,
+    )
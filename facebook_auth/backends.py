@@ -1,3 +1,4 @@
+import collections
 import logging
 from datetime import datetime
 
@@ -7,6 +8,10 @@ except ImportError:
     import urlparse
 
 from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError
+from django.db import transaction
 from django.utils import timezone
 
 from facepy import exceptions
@@ -17,6 +22,10 @@ from facebook_auth.facepy_wrapper.utils import TokenParsingError
 
 logger = logging.getLogger(__name__)
 
+LOGIN_GRAPH_BATCH = getattr(settings, 'FACEBOOK_AUTH_LOGIN_GRAPH_BATCH', False)
+USER_CACHE_TIMEOUT = getattr(settings, 'FACEBOOK_AUTH_USER_CACHE_TIMEOUT', 0)
+USER_CACHE_FIELDS = getattr(settings, 'FACEBOOK_AUTH_USER_CACHE_FIELDS', None)
+
 
 def _truncate(word, length, to_zero=False):
     if to_zero and len(word) > length:
@@ -27,6 +36,7 @@ def _truncate(word, length, to_zero=False):
 
 class UserFactory(object):
     user_facebook_fields = ['first_name', 'last_name', 'email', 'name']
+    GRAPH_IDS_CHUNK_SIZE = 50
 
     fallback_expiration_date = datetime(1990, 10, 10, 0, 0, 1).replace(
         tzinfo=timezone.utc)
@@ -34,44 +44,109 @@ class UserFactory(object):
     def __create_username(self, profile):
             return profile['id']  # TODO better username
 
-    def _product_user(self, access_token, profile):
+    def _product_user(self, access_token, profile, long_lived_token=None):
         user_id = int(profile['id'])
         username = self.__create_username(profile)
-        user, created = models.FacebookUser.objects.get_or_create(
-            user_id=user_id, defaults={'username': username})
-
-        if user.username != username:
-            logger.warning('FacebookUser username mismatch', extra={
-                'old_username': user.username,
-                'new_username': username,
-                'user_django_id': user.id,
-                'user_facebook_id': user_id,
-                'user_email': user.email
-            })
-        if created:
-            user.set_unusable_password()
-
-        def copy_field(field, to_zero=False):
-            if field in profile:
-                length = user._meta.get_field(field).max_length
-                setattr(user, field, _truncate(profile[field], length,
-                        to_zero=to_zero))
-
-        copy_field('email', True)
-        copy_field('first_name')
-        copy_field('last_name')
-        if access_token is not None:
-            models.FacebookTokenManager().insert_token(
-                access_token, str(user.user_id))
-        user.save()
-        self.create_profile_object(profile, user)
+        fields = self._get_user_fields(profile)
+        with transaction.atomic():
+            defaults = dict(fields, username=username,
+                            password=make_password(None))
+            user, created = models.FacebookUser.objects.get_or_create(
+                user_id=user_id, defaults=defaults)
+
+            if user.username != username:
+                logger.warning('FacebookUser username mismatch', extra={
+                    'old_username': user.username,
+                    'new_username': username,
+                    'user_django_id': user.id,
+                    'user_facebook_id': user_id,
+                    'user_email': user.email
+                })
+            if not created:
+                self._update_user(user, fields)
+            if access_token is not None:
+                models.FacebookTokenManager().insert_token(
+                    access_token, str(user.user_id),
+                    long_lived_token=long_lived_token)
+        self._update_profile(profile, user)
         return user
 
+    def _product_users(self, profiles):
+        """Provision users of many profiles, without tokens.
+
+        Existing users are read with one query and saved only if changed.
+        Multi-table inheritance of FacebookUser rules out bulk_create, so
+        missing users are created one by one, all in one transaction.
+        Profiles are updated after the transaction.
+        """
+        profiles = collections.OrderedDict(
+            (int(profile['id']), profile) for profile in profiles)
+        try:
+            with transaction.atomic():
+                users = dict(
+                    (user.user_id, user) for user
+                    in models.FacebookUser.objects.filter(
+                        user_id__in=list(profiles)))
+                for user_id, profile in profiles.items():
+                    fields = self._get_user_fields(profile)
+                    if user_id in users:
+                        self._update_user(users[user_id], fields)
+                    else:
+                        users[user_id] = models.FacebookUser.objects.create(
+                            user_id=user_id,
+                            username=self.__create_username(profile),
+                            password=make_password(None), **fields)
+        except IntegrityError:
+            logger.info('Users created concurrently, creating one by one.')
+            return [self._product_user(None, profile)
+                    for profile in profiles.values()]
+        for user_id, profile in profiles.items():
+            self._update_profile(profile, users[user_id])
+        return [users[user_id] for user_id in profiles]
+
+    def _update_profile(self, profile, user):
+        if models.DEFERRED_PROFILE:
+            models.schedule_profile_update(user.user_id, profile)
+        else:
+            self.create_profile_object(profile, user)
+
+    @staticmethod
+    def _get_user_fields(profile):
+        fields = {}
+        for field, to_zero in [('email', True), ('first_name', False),
+                               ('last_name', False)]:
+            if field in profile:
+                length = models.FacebookUser._meta.get_field(field).max_length
+                fields[field] = _truncate(profile[field], length,
+                                          to_zero=to_zero)
+        return fields
+
+    @staticmethod
+    def _update_user(user, fields):
+        changed = sorted(field for field, value in fields.items()
+                         if getattr(user, field) != value)
+        if changed:
+            for field in changed:
+                setattr(user, field, fields[field])
+            user.save(update_fields=changed)
+
     def get_user(self, access_token):
         fields = ','.join(self.user_facebook_fields)
+        if LOGIN_GRAPH_BATCH and getattr(
+                settings, 'REQUEST_LONG_LIVED_ACCESS_TOKEN', False):
+            try:
+                profile, long_lived_token = (
+                    utils.get_profile_and_long_lived_access_token(
+                        access_token, fields))
+            except exceptions.FacepyError as e:
+                logger.info('Login batch request failed: %s', e)
+            else:
+                return self._product_user(access_token, profile,
+                                          long_lived_token)
         profile = utils.get_from_graph_api(
             utils.get_graph(access_token),
-            'me?fields=%s' % fields)
+            'me?fields=%s' % fields,
+            retry_policy=utils.INTERACTIVE_RETRY_POLICY)
         return self._product_user(access_token, profile)
 
     def _get_fallback_expiration_date(self):
@@ -85,6 +160,43 @@ class UserFactory(object):
         profile = utils.get_from_graph_api(api, uid)
         return self._product_user(None, profile)
 
+    def get_users_by_ids(self, uids):
+        """Fetch profiles with ?ids= requests and provision their users.
+
+        Profiles are fetched GRAPH_IDS_CHUNK_SIZE at a time. Graph API
+        rejects the whole request when any of its ids is invalid, so such
+        a chunk is fetched again id by id and the failing ids are skipped.
+        """
+        api = utils.get_application_graph(
+            version=settings.FACEBOOK_API_VERSION
+        )
+        fields = ','.join(self.user_facebook_fields)
+        users = []
+        for chunk in utils.chunks(uids, self.GRAPH_IDS_CHUNK_SIZE):
+            try:
+                profiles = utils.get_from_graph_api(
+                    api, '', ids=','.join(str(uid) for uid in chunk),
+                    fields=fields)
+            except exceptions.FacebookError as e:
+                if utils.DEFAULT_RETRY_POLICY.is_retryable(e):
+                    raise
+                profiles = self._get_profiles_one_by_one(api, chunk, fields)
+            users.extend(self._product_users(
+                profiles[str(uid)] for uid in chunk if str(uid) in profiles))
+        return users
+
+    def _get_profiles_one_by_one(self, api, uids, fields):
+        profiles = {}
+        for uid in uids:
+            try:
+                profiles[str(uid)] = utils.get_from_graph_api(
+                    api, str(uid), fields=fields)
+            except exceptions.FacebookError as e:
+                if utils.DEFAULT_RETRY_POLICY.is_retryable(e):
+                    raise
+                logger.info('Skipping Facebook user %s.', uid, exc_info=True)
+        return profiles
+
     def create_profile_object(self, profile, user):
         if 'facebook_profile' in settings.INSTALLED_APPS:
             from facebook_profile import models as profile_models
@@ -128,8 +240,23 @@ class FacebookBackend(object):
         return naive.replace(tzinfo=timezone.utc)
 
     def get_user(self, user_id):
+        if not USER_CACHE_TIMEOUT:
+            return self._get_user(user_id)
+        key = models.get_user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = self._get_user(user_id)
+            if user is not None:
+                cache.set(key, user, USER_CACHE_TIMEOUT)
+        return user
+
+    def _get_user(self, user_id):
+        users = models.FacebookUser.objects.all()
+        if USER_CACHE_FIELDS:
+            # Session auth hash is computed from password on every request.
+            users = users.only('password', *USER_CACHE_FIELDS)
         try:
-            return models.FacebookUser.objects.get(pk=user_id)
+            return users.get(pk=user_id)
         except models.FacebookUser.DoesNotExist: #@UndefinedVariable
             return None
 
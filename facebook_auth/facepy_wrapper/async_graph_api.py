@@ -0,0 +1,182 @@
+"""Asyncio counterpart of ObservableGraphAPI.
+
+Requires Python 3.5+ and aiohttp (``pip install django-facebook-auth[async]``).
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+
+import aiohttp
+import facepy
+from facepy import exceptions
+
+from . import graph_api
+from .utils import TokenParsingError
+from .utils import _parse_access_token_response
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+
+# facepy parses Graph API responses and raises its exceptions; reuse it so
+# errors are the same as from ObservableGraphAPI.
+_parser = facepy.GraphAPI()
+
+
+class AsyncObservableGraphAPI(object):
+    def __init__(self, oauth_token=False, url=graph_api.FACEBOOK_GRAPH_URL,
+                 appsecret=False, timeout=None, version=None, session=None):
+        self.oauth_token = oauth_token
+        self.url = url.strip('/')
+        self.appsecret = appsecret
+        self.timeout = timeout
+        self.version = version
+        self.last_response = None
+        self._session = session
+        self._owns_session = session is None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def close(self):
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def get(self, path='', **options):
+        return await self._query('GET', path, options)
+
+    async def post(self, path='', **data):
+        return await self._query('POST', path, data)
+
+    async def batch(self, requests):
+        """Return list of results, exceptions are returned not raised."""
+        results = []
+        for i in range(0, len(requests), BATCH_SIZE):
+            group = requests[i:i + BATCH_SIZE]
+            responses = await self.post(batch=json.dumps(group))
+            for response, request in zip(responses, group):
+                if not response:
+                    results.append(None)
+                    continue
+                try:
+                    results.append(_parser._parse(response['body']))
+                except exceptions.FacepyError as e:
+                    e.request = request
+                    results.append(e)
+        return results
+
+    async def _query(self, method, path, data):
+        url = self._get_url(path)
+        data = self._prepare_data(data)
+        kwargs = {'params' if method == 'GET' else 'data': data}
+        if self.timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=self.timeout)
+        handlers = graph_api.FacebookConnectionObservers()
+        handlers.handle_request(method, url, **kwargs)
+        response = None
+        try:
+            try:
+                async with self.session.request(method, url,
+                                                **kwargs) as response:
+                    self.last_response = response
+                    body = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise exceptions.HTTPError(e)
+            return _parser._parse(body)
+        except exceptions.FacebookError as e:
+            handlers.handle_error(e)
+            raise
+        finally:
+            asyncio.get_event_loop().run_in_executor(
+                None, _finalize, handlers, response, graph_api.now_ns())
+
+    def _get_url(self, path):
+        if self.version:
+            return '%s/v%s/%s' % (self.url, self.version, path.strip('/'))
+        return '%s/%s' % (self.url, path.strip('/'))
+
+    def _prepare_data(self, data):
+        prepared = {}
+        for key, value in data.items():
+            if isinstance(value, (list, dict, set)):
+                value = json.dumps(list(value) if isinstance(value, set)
+                                   else value)
+            elif isinstance(value, bool):
+                value = 'true' if value else 'false'
+            elif value is None:
+                continue
+            prepared[key] = str(value)
+        if self.oauth_token:
+            prepared['access_token'] = self.oauth_token
+            if self.appsecret:
+                prepared['appsecret_proof'] = hmac.new(
+                    self.appsecret.encode('utf-8'),
+                    msg=self.oauth_token.encode('utf-8'),
+                    digestmod=hashlib.sha256).hexdigest()
+        return prepared
+
+
+def _finalize(handlers, response, end):
+    """Record usage and notify observers outside of the event loop."""
+    try:
+        if response is not None:
+            handlers.handle_response(response)
+        handlers.finalize(end)
+    except Exception:
+        logger.exception('Handling Graph API communication failed.')
+
+
+def get_graph(*args, **kwargs):
+    return AsyncObservableGraphAPI(*args, **kwargs)
+
+
+async def get_long_lived_access_token(access_token, client_id, client_secret,
+                                      session=None):
+    args = {
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'grant_type': 'fb_exchange_token',
+        'fb_exchange_token': access_token,
+    }
+    async with get_graph(session=session) as graph:
+        data = await graph.get('/oauth/access_token', **args)
+    try:
+        return _parse_access_token_response(data)
+    except TokenParsingError:
+        logger.warning('Invalid Facebook response.')
+        raise
+
+
+async def get_access_token(client_id, client_secret, code=None,
+                           redirect_uri=None, timeout=None, session=None):
+    args = {
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'redirect_uri': redirect_uri,
+        'code': code
+    }
+    async with get_graph(timeout=timeout, session=session) as graph:
+        try:
+            data = await graph.get('/oauth/access_token', **args)
+        except exceptions.FacepyError:
+            logger.warning("Facebook login connection error")
+            raise
+    try:
+        return _parse_access_token_response(data).access_token
+    except TokenParsingError as e:
+        args['client_secret'] = '*******%s' % args['client_secret'][-4:]
+        logger.error(e, extra={'facebook_response': data,
+                               'sent_args': args})
+        raise
@@ -1,11 +1,23 @@
+import datetime
 import importlib
 import logging
+import os
+import threading
+import time
+import timeit
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import facepy
+import requests
+from requests import adapters
 from django.conf import settings
-from django.utils import timezone
 from facepy.exceptions import FacebookError
 
+from . import usage
+
 
 def get_class(class_name):
     module_name, class_name = class_name.rsplit(".", 1)
@@ -18,8 +30,118 @@ def get_graph_observer_classes(graph_observers):
     return list(map(get_class, graph_observers))
 
 
+class ObserverClass(object):
+    """Adapts observer class instantiated for every communication."""
+
+    def __init__(self, observer_class):
+        self.observer_class = observer_class
+
+    def observe(self, request, response, error, time):
+        observer = self.observer_class(request, response, error, time)
+        observer.handle_facebook_communication()
+
+
+def create_graph_observers(observer_classes):
+    """Instantiate observers once.
+
+    Classes with `reusable = True` are created once and their `observe`
+    method is called for every communication. Other classes keep being
+    instantiated with communication details.
+    """
+    return [observer_class()
+            if getattr(observer_class, 'reusable', False) is True
+            else ObserverClass(observer_class)
+            for observer_class in observer_classes]
+
+
+class SynchronousDispatcher(object):
+    def dispatch(self, observers, *args):
+        for observer in observers:
+            observer.observe(*args)
+
+
+class QueuedDispatcher(object):
+    """Runs observers in a background thread, never blocking requests.
+
+    Communications are dropped when the queue is full.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def dispatch(self, observers, *args):
+        try:
+            self._get_queue().put_nowait((observers, args))
+        except queue.Full:
+            logger.warning('Graph observers queue is full.')
+
+    def _get_queue(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(self.size)
+                    thread = threading.Thread(target=self._run,
+                                              args=(self._queue,))
+                    thread.daemon = True
+                    thread.start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    @staticmethod
+    def _run(observers_queue):
+        while True:
+            observers, args = observers_queue.get()
+            for observer in observers:
+                try:
+                    observer.observe(*args)
+                except Exception:
+                    logger.exception('Graph observer failed.')
+
+
+def _perf_counter_ns():
+    return int(timeit.default_timer() * 1e9)
+
+
+now_ns = getattr(time, 'perf_counter_ns', _perf_counter_ns)
+
 FACEBOOK_GRAPH_OBSERVERS = getattr(settings, 'FACEBOOK_GRAPH_OBSERVERS', [])
 GRAPH_OBSERVER_CLASSES = get_graph_observer_classes(FACEBOOK_GRAPH_OBSERVERS)
+GRAPH_OBSERVERS = create_graph_observers(GRAPH_OBSERVER_CLASSES)
+FACEBOOK_GRAPH_OBSERVERS_QUEUE_SIZE = getattr(
+    settings, 'FACEBOOK_GRAPH_OBSERVERS_QUEUE_SIZE', 0)
+DISPATCHER = (QueuedDispatcher(FACEBOOK_GRAPH_OBSERVERS_QUEUE_SIZE)
+              if FACEBOOK_GRAPH_OBSERVERS_QUEUE_SIZE
+              else SynchronousDispatcher())
+FACEBOOK_GRAPH_URL = getattr(settings, 'FACEBOOK_GRAPH_URL',
+                             'https://graph.facebook.com')
+FACEBOOK_GRAPH_POOL_SIZE = getattr(settings, 'FACEBOOK_GRAPH_POOL_SIZE', 10)
+FACEBOOK_GRAPH_CONNECTION_RETRIES = getattr(
+    settings, 'FACEBOOK_GRAPH_CONNECTION_RETRIES', 0)
+
+_local = threading.local()
+
+
+def get_session():
+    """Return requests session shared by all graphs of current thread.
+
+    Sessions are not inherited by forked processes, so connections are
+    never shared with the parent.
+    """
+    session = getattr(_local, 'session', None)
+    if session is None or _local.pid != os.getpid():
+        session = requests.Session()
+        adapter = adapters.HTTPAdapter(
+            pool_connections=FACEBOOK_GRAPH_POOL_SIZE,
+            pool_maxsize=FACEBOOK_GRAPH_POOL_SIZE,
+            max_retries=FACEBOOK_GRAPH_CONNECTION_RETRIES)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _local.session = session
+        _local.pid = os.getpid()
+    return session
 
 
 logger = logging.getLogger(__name__)
@@ -27,69 +149,83 @@ logger = logging.getLogger(__name__)
 
 class ObservableGraphAPI(facepy.GraphAPI):
     def __init__(self, *args, **kwargs):
+        if len(args) < 2:
+            kwargs.setdefault('url', FACEBOOK_GRAPH_URL)
         super(ObservableGraphAPI, self).__init__(*args, **kwargs)
-        self.session = ObservableSession(self.session)
+        self.session = ObservableSession(get_session())
 
     def _query(self, *args, **kwargs):
         handlers = FacebookConnectionObservers()
-        self.session.observers.append(handlers)
+        previous_handlers = self.session.set_handlers(handlers)
         try:
             response = super(ObservableGraphAPI, self)._query(*args, **kwargs)
         except FacebookError as e:
             handlers.handle_error(e)
             raise
         finally:
-            self.session.observers.remove(handlers)
+            self.session.set_handlers(previous_handlers)
             handlers.finalize()
         return response
 
     def batch(self, requests):
-        logger.warn('Errors of batch method are not watched')
+        # Only the batch request itself is observed, errors of its items
+        # are returned to the caller.
         return super(ObservableGraphAPI, self).batch(requests)
 
 
 class ObservableSession(object):
+    """Notifies handlers of the query made by the current thread."""
+
     def __init__(self, other_session):
         self.other_session = other_session
-        self.observers = []
+        self._local = threading.local()
+
+    @property
+    def last_response(self):
+        return getattr(self._local, 'last_response', None)
+
+    def set_handlers(self, handlers):
+        previous_handlers = getattr(self._local, 'handlers', None)
+        self._local.handlers = handlers
+        return previous_handlers
 
     def request(self, *args, **kwargs):
-        self.notify_request(*args, **kwargs)
+        handlers = getattr(self._local, 'handlers', None)
+        if handlers is not None:
+            handlers.handle_request(*args, **kwargs)
         response = self.other_session.request(*args, **kwargs)
-        self.notify_response(response)
+        self._local.last_response = response
+        if handlers is not None:
+            handlers.handle_response(response)
         return response
 
-    def notify_request(self, *args, **kwargs):
-        for observer in self.observers:
-            observer.handle_request(*args, **kwargs)
-
-    def notify_response(self, response):
-        for observer in self.observers:
-            observer.handle_response(response)
-
 
 class FacebookConnectionObservers(object):
+    __slots__ = ('request', 'response', 'error', 'start')
+
     def __init__(self):
         self.request = None
         self.response = None
         self.error = None
-        self.start = timezone.now()
+        self.start = now_ns()
 
     def handle_request(self, *args, **kwargs):
         self.request = RequestInfo(*args, **kwargs)
 
     def handle_response(self, response):
         self.response = response
+        usage.GOVERNOR.record(getattr(response, 'headers', None))
 
     def handle_error(self, error):
         self.error = error
 
-    def finalize(self):
-        time = timezone.now() - self.start
-        for observer_class in GRAPH_OBSERVER_CLASSES:
-            observer = observer_class(
-                self.request, self.response, self.error, time)
-            observer.handle_facebook_communication()
+    def finalize(self, end=None):
+        if not GRAPH_OBSERVERS:
+            return
+        end = now_ns() if end is None else end
+        time = datetime.timedelta(microseconds=(end - self.start) / 1e3)
+        DISPATCHER.dispatch(GRAPH_OBSERVERS, self.request, self.response,
+                            self.error, time)
 
 
 class RequestInfo(object):
@@ -0,0 +1,260 @@
+"""Graph API metrics collected by a built-in graph observer.
+
+Add ``'facebook_auth.facepy_wrapper.metrics.MetricsObserver'`` to
+FACEBOOK_GRAPH_OBSERVERS. Exporters listed in FACEBOOK_GRAPH_METRICS_EXPORTERS
+get every communication; PrometheusExporter renders the process registry in
+Prometheus text format on demand.
+"""
+import collections
+import importlib
+import os
+import re
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+try:
+    import urllib.parse as urlparse
+except ImportError:
+    import urlparse
+
+LATENCY_BUCKETS = getattr(settings, 'FACEBOOK_GRAPH_METRICS_BUCKETS',
+                          (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+FACEBOOK_GRAPH_METRICS_EXPORTERS = getattr(
+    settings, 'FACEBOOK_GRAPH_METRICS_EXPORTERS', [])
+
+Communication = collections.namedtuple(
+    'Communication',
+    ['endpoint', 'method', 'duration', 'status', 'error_code', 'bytes'])
+
+_VERSION = re.compile(r'^v\d+(\.\d+)?$')
+_ID = re.compile(r'^\d+(_\d+)?$')
+
+
+def normalize_endpoint(url):
+    """Turn request url or query into endpoint name without ids."""
+    path = urlparse.urlparse(url).path.strip('/')
+    parts = [part for part in path.split('/') if part]
+    if parts and _VERSION.match(parts[0]):
+        parts = parts[1:]
+    parts = ['{id}' if _ID.match(part) else part for part in parts]
+    return '/' + '/'.join(parts)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts),
+                'sum': self.sum, 'count': self.count}
+
+
+class Registry(object):
+    """Process-local metrics keyed by endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.latency = collections.defaultdict(Histogram)
+        self.errors = collections.Counter()
+        self.retries = collections.Counter()
+        self.bytes = collections.Counter()
+
+    def record(self, communication):
+        with self._lock:
+            self.latency[communication.endpoint].observe(
+                communication.duration)
+            self.bytes[communication.endpoint] += communication.bytes
+            if communication.error_code is not None:
+                self.errors[(communication.endpoint,
+                             str(communication.error_code))] += 1
+
+    def record_retry(self, endpoint, error_code):
+        with self._lock:
+            self.retries[(endpoint, str(error_code))] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'latency': dict((endpoint, histogram.snapshot())
+                                for endpoint, histogram
+                                in self.latency.items()),
+                'errors': dict(('%s %s' % key, count)
+                               for key, count in self.errors.items()),
+                'retries': dict(('%s %s' % key, count)
+                                for key, count in self.retries.items()),
+                'bytes': dict(self.bytes),
+            }
+
+
+REGISTRY = Registry()
+
+
+class PrometheusExporter(object):
+    def handle(self, communication, registry):
+        pass
+
+    def render(self, registry=REGISTRY):
+        lines = ['# TYPE facebook_graph_request_seconds histogram']
+        with registry._lock:
+            for endpoint, histogram in sorted(registry.latency.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(self._line('request_seconds_bucket',
+                                            cumulative, endpoint=endpoint,
+                                            le=str(bound)))
+                lines.append(self._line('request_seconds_bucket',
+                                        histogram.count, endpoint=endpoint,
+                                        le='+Inf'))
+                lines.append(self._line('request_seconds_sum', histogram.sum,
+                                        endpoint=endpoint))
+                lines.append(self._line('request_seconds_count',
+                                        histogram.count, endpoint=endpoint))
+            lines.append('# TYPE facebook_graph_errors_total counter')
+            for (endpoint, code), count in sorted(registry.errors.items()):
+                lines.append(self._line('errors_total', count,
+                                        endpoint=endpoint, code=code))
+            lines.append('# TYPE facebook_graph_retries_total counter')
+            for (endpoint, code), count in sorted(registry.retries.items()):
+                lines.append(self._line('retries_total', count,
+                                        endpoint=endpoint, code=code))
+            lines.append('# TYPE facebook_graph_response_bytes_total counter')
+            for endpoint, count in sorted(registry.bytes.items()):
+                lines.append(self._line('response_bytes_total', count,
+                                        endpoint=endpoint))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _line(name, value, **labels):
+        labels = ','.join('%s="%s"' % (key, labels[key])
+                          for key in sorted(labels))
+        return 'facebook_graph_%s{%s} %s' % (name, labels, value)
+
+
+class StatsdExporter(object):
+    prefix = getattr(settings, 'FACEBOOK_GRAPH_STATSD_PREFIX',
+                     'facebook.graph')
+    address = (getattr(settings, 'FACEBOOK_GRAPH_STATSD_HOST', 'localhost'),
+               getattr(settings, 'FACEBOOK_GRAPH_STATSD_PORT', 8125))
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def handle(self, communication, registry):
+        name = '%s.%s' % (self.prefix, self._name(communication.endpoint))
+        metrics = ['%s.latency:%d|ms' % (name, communication.duration * 1000),
+                   '%s.bytes:%d|c' % (name, communication.bytes)]
+        if communication.error_code is not None:
+            metrics.append('%s.errors.%s:1|c' % (name,
+                                                 communication.error_code))
+        try:
+            self.socket.sendto('\n'.join(metrics).encode('utf-8'),
+                               self.address)
+        except socket.error:
+            pass
+
+    @staticmethod
+    def _name(endpoint):
+        name = re.sub(r'[^a-zA-Z0-9_]+', '_', endpoint).strip('_')
+        return name or 'root'
+
+
+class CacheSnapshotExporter(object):
+    """Stores snapshot of process registry in Django cache every interval."""
+    interval = getattr(settings, 'FACEBOOK_GRAPH_METRICS_CACHE_INTERVAL', 10)
+    cache_key = 'facebook_auth_graph_metrics-{}'
+
+    def __init__(self):
+        self.exported_at = 0
+
+    def handle(self, communication, registry):
+        now = time.time()
+        if now - self.exported_at >= self.interval:
+            self.exported_at = now
+            cache.set(self.cache_key.format(os.getpid()), registry.snapshot(),
+                      self.interval * 10)
+
+
+_exporters = None
+
+
+def get_exporters():
+    """Instantiate exporters on first use.
+
+    Exporters may live in this module, so they cannot be imported while it
+    is being loaded.
+    """
+    global _exporters
+    if _exporters is None:
+        exporters = []
+        for class_name in FACEBOOK_GRAPH_METRICS_EXPORTERS:
+            module_name, class_name = class_name.rsplit('.', 1)
+            module = importlib.import_module(module_name)
+            exporters.append(getattr(module, class_name)())
+        _exporters = exporters
+    return _exporters
+
+
+class MetricsObserver(object):
+    reusable = True
+
+    def observe(self, request, response, error, time):
+        communication = self.get_communication(request, response, error,
+                                               time)
+        REGISTRY.record(communication)
+        for exporter in get_exporters():
+            exporter.handle(communication, REGISTRY)
+
+    def get_communication(self, request, response, error, time):
+        url = getattr(request, 'url', '') or ''
+        method = getattr(request, 'method', None)
+        endpoint = normalize_endpoint(url)
+        if method == 'POST' and endpoint == '/':
+            endpoint = '/batch'
+        status = getattr(response, 'status_code', None)
+        return Communication(
+            endpoint=endpoint,
+            method=method,
+            duration=time.total_seconds(),
+            status=status,
+            error_code=self._get_error_code(error, status),
+            bytes=self._get_bytes(response),
+        )
+
+    @staticmethod
+    def _get_error_code(error, status):
+        if error is not None:
+            return getattr(error, 'code', None) or 'unknown'
+        if status is not None and status >= 400:
+            return 'http_%d' % status
+        return None
+
+    @staticmethod
+    def _get_bytes(response):
+        headers = getattr(response, 'headers', None) or {}
+        try:
+            if 'Content-Length' in headers:
+                return int(headers['Content-Length'])
+            return len(getattr(response, 'content', None) or b'')
+        except (TypeError, ValueError):
+            return 0
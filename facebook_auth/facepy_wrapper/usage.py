@@ -0,0 +1,179 @@
+import collections
+import json
+import numbers
+import time
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from django.conf import settings
+from django.core.cache import cache
+
+APP_USAGE_HEADER = 'X-App-Usage'
+BUSINESS_USE_CASE_USAGE_HEADER = 'X-Business-Use-Case-Usage'
+USAGE_FIELDS = ('call_count', 'total_time', 'total_cputime')
+
+Usage = collections.namedtuple('Usage',
+                               ['percentage', 'regain_access_seconds'])
+NO_USAGE = Usage(percentage=0, regain_access_seconds=0)
+
+PRIORITY_LOW = 'low'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_HIGH = 'high'
+USAGE_LIMITS = getattr(settings, 'FACEBOOK_GRAPH_USAGE_LIMITS', {
+    PRIORITY_LOW: 75,
+    PRIORITY_NORMAL: 90,
+})
+USAGE_TIMEOUT = getattr(settings, 'FACEBOOK_GRAPH_USAGE_TIMEOUT', 60)
+USAGE_RECORD_INTERVAL = getattr(settings,
+                                'FACEBOOK_GRAPH_USAGE_RECORD_INTERVAL', 5)
+
+
+def get_usage(headers):
+    """Parse Facebook rate limiting headers into highest usage percentage."""
+    usages = list(get_business_usage(headers).values())
+    app_usage = get_app_usage(headers)
+    if app_usage is not None:
+        usages.append(app_usage)
+    return _get_highest_usage(usages)
+
+
+def get_app_usage(headers):
+    """Parse app-wide usage, None if the header is absent or invalid."""
+    if not isinstance(headers, Mapping):
+        return None
+    app_usage = _loads(headers.get(APP_USAGE_HEADER))
+    if not isinstance(app_usage, dict):
+        return None
+    return _get_entry_usage(app_usage)
+
+
+def get_business_usage(headers):
+    """Parse usage of every business id from business use case header."""
+    if not isinstance(headers, Mapping):
+        return {}
+    business_usage = _loads(headers.get(BUSINESS_USE_CASE_USAGE_HEADER))
+    if not isinstance(business_usage, dict):
+        return {}
+    return dict(
+        (business_id, _get_highest_usage(
+            [_get_entry_usage(entry) for entry in entries
+             if isinstance(entry, dict)]))
+        for business_id, entries in business_usage.items()
+        if isinstance(entries, list))
+
+
+def _get_entry_usage(entry):
+    percentage = 0
+    for field in USAGE_FIELDS:
+        value = entry.get(field)
+        if isinstance(value, numbers.Number):
+            percentage = max(percentage, value)
+    minutes = entry.get('estimated_time_to_regain_access')
+    if not isinstance(minutes, numbers.Number):
+        minutes = 0
+    return Usage(percentage=percentage, regain_access_seconds=minutes * 60)
+
+
+def _get_highest_usage(usages):
+    return Usage(
+        percentage=max([u.percentage for u in usages] or [0]),
+        regain_access_seconds=max([u.regain_access_seconds for u in usages]
+                                  or [0]))
+
+
+def _loads(value):
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return None
+
+
+class UsageLimitExceeded(Exception):
+    def __init__(self, priority, retry_after):
+        super(UsageLimitExceeded, self).__init__(priority, retry_after)
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+class UsageGovernor(object):
+    """Keeps latest Graph API usage of the app in Django cache.
+
+    Calls of given priority are allowed while usage is below its limit.
+    High priority calls (interactive logins) are never held back. Usage of
+    business use cases is kept per business id and limits only calls made
+    for that business.
+
+    A process writes usage below all limits at most once every
+    record_interval seconds; usage reaching or leaving a limit is written
+    at once.
+    """
+    cache_key = 'facebook_auth_graph_usage'
+    business_cache_key = 'facebook_auth_graph_usage-business-{}'
+
+    def __init__(self, limits=None, timeout=USAGE_TIMEOUT,
+                 record_interval=USAGE_RECORD_INTERVAL):
+        self.limits = USAGE_LIMITS if limits is None else limits
+        self.timeout = timeout
+        self.record_interval = record_interval
+        self._recorded = {}
+
+    def record(self, headers):
+        app_usage = get_app_usage(headers)
+        if app_usage is not None:
+            self._set_usage(self.cache_key, app_usage)
+        for business_id, usage in get_business_usage(headers).items():
+            self._set_usage(self.business_cache_key.format(business_id),
+                            usage)
+
+    def _set_usage(self, key, usage):
+        now = time.time()
+        limiting = self._is_limiting(usage)
+        recorded_at, was_limiting = self._recorded.get(key, (None, False))
+        if (not limiting and not was_limiting and recorded_at is not None and
+                now - recorded_at < self.record_interval):
+            return
+        self._recorded[key] = (now, limiting)
+        cache.set(key, (usage.percentage, now + usage.regain_access_seconds),
+                  max(self.timeout, usage.regain_access_seconds))
+
+    def _is_limiting(self, usage):
+        return bool(usage.regain_access_seconds or
+                    usage.percentage >= min(list(self.limits.values()) or
+                                            [float('inf')]))
+
+    def get_usage(self, business_id=None):
+        key = (self.cache_key if business_id is None
+               else self.business_cache_key.format(business_id))
+        percentage, regain_access_at = cache.get(key, (0, 0))
+        return Usage(percentage=percentage,
+                     regain_access_seconds=max(0, regain_access_at -
+                                               time.time()))
+
+    def get_retry_after(self, priority, business_id=None):
+        """Return seconds until call of priority may be done, 0 if now."""
+        limit = self.limits.get(priority)
+        if limit is None:
+            return 0
+        usage = self.get_usage()
+        if business_id is not None:
+            usage = _get_highest_usage([usage, self.get_usage(business_id)])
+        if usage.regain_access_seconds:
+            return usage.regain_access_seconds
+        if usage.percentage >= limit:
+            return self.timeout
+        return 0
+
+    def acquire(self, priority, max_wait=0, business_id=None):
+        """Wait up to max_wait seconds or raise UsageLimitExceeded."""
+        retry_after = self.get_retry_after(priority, business_id)
+        if retry_after > max_wait:
+            raise UsageLimitExceeded(priority, retry_after)
+        if retry_after:
+            time.sleep(retry_after)
+
+
+GOVERNOR = UsageGovernor()
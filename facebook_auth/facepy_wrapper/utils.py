@@ -7,8 +7,10 @@ from . import graph_api
 
 try:
     import urllib.parse as urlparse
+    from urllib.parse import urlencode
 except ImportError:
     import urlparse
+    from urllib import urlencode
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +21,20 @@ def get_graph(*args, **kwargs):
     return graph_api.ObservableGraphAPI(*args, **kwargs)
 
 
+def get_application_access_token(client_id, client_secret, version=None):
+    graph = get_graph(version=version)
+    data = graph.get('/oauth/access_token', client_id=client_id,
+                     client_secret=client_secret,
+                     grant_type='client_credentials')
+    if isinstance(data, dict):
+        access_token = data.get('access_token')
+    else:
+        access_token = urlparse.parse_qs(data).get('access_token', [None])[-1]
+    if not access_token:
+        raise TokenParsingError('No application access token in response.')
+    return access_token
+
+
 def get_long_lived_access_token(access_token, client_id, client_secret):
     graph = get_graph()
     args = {
@@ -35,6 +51,39 @@ def get_long_lived_access_token(access_token, client_id, client_secret):
         raise
 
 
+def get_profile_and_long_lived_access_token(access_token, client_id,
+                                            client_secret, fields,
+                                            version=None, timeout=None):
+    """Fetch profile and exchange access token in one batch request.
+
+    Returns profile and AccessTokenResponse or None if exchange failed.
+    Raises FacepyError if profile was not fetched.
+    """
+    graph = get_graph(access_token, version=version, timeout=timeout)
+    exchange = urlencode({
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'grant_type': 'fb_exchange_token',
+        'fb_exchange_token': access_token,
+    })
+    profile, data = list(graph.batch([
+        {'method': 'GET', 'relative_url': 'me?fields=%s' % fields},
+        {'method': 'GET', 'relative_url': 'oauth/access_token?' + exchange},
+    ]))
+    if isinstance(profile, Exception):
+        raise profile
+    if not isinstance(profile, dict):
+        raise exceptions.FacepyError('No profile in batch response.')
+    if data is None or isinstance(data, Exception):
+        logger.info('Exchanging access token failed: %s', data)
+        return profile, None
+    try:
+        return profile, _parse_access_token_response(data)
+    except TokenParsingError:
+        logger.warning('Invalid Facebook response.')
+        return profile, None
+
+
 def get_access_token(client_id, client_secret, code=None, redirect_uri=None, timeout=None):
     graph = get_graph(timeout=timeout)
     args = {
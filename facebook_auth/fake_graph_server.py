@@ -0,0 +1,284 @@
+"""Local stand-in for Facebook Graph API used in load tests.
+
+Run it with::
+
+    python -m facebook_auth.fake_graph_server --port 8001 --latency 0.05 \\
+        --error-rate 0.01 --throttle-rate 0.01
+
+and point the app at it with ``FACEBOOK_GRAPH_URL = 'http://localhost:8001'``.
+
+Implemented endpoints: ``/oauth/access_token``, ``/debug_token``, ``/me``,
+``/<user id>``, ``?ids=``, ``/me/friends`` with cursor paging and batch
+requests (``POST /`` with ``batch``). Tokens are fake and encode the user
+id, so any code from the OAuth dialog can be exchanged for a token.
+"""
+import argparse
+import base64
+import collections
+import json
+import random
+import threading
+import time
+from wsgiref import simple_server
+
+try:
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl
+    from urllib.parse import urlencode
+except ImportError:
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl
+    from urllib import urlencode
+
+TOKEN_PREFIX = 'FAKE'
+TOKEN_LIFETIME = 60 * 24 * 60 * 60
+SCOPES = ['public_profile', 'email', 'user_friends']
+THROTTLING_MESSAGES = {
+    4: 'Application request limit reached',
+    17: 'User request limit reached',
+    32: 'Page request limit reached',
+    613: 'Calls to this api have exceeded the rate limit.',
+}
+
+
+class GraphError(Exception):
+    def __init__(self, status, code, message, error_type='OAuthException',
+                 is_transient=False):
+        super(GraphError, self).__init__(message)
+        self.status = status
+        self.body = {'error': {
+            'message': message,
+            'type': error_type,
+            'code': code,
+            'is_transient': is_transient,
+        }}
+
+
+class FakeGraph(object):
+    """WSGI application answering like Graph API."""
+
+    def __init__(self, users=100000, friends=300, latency=0.0, jitter=0.0,
+                 error_rate=0.0, throttle_rate=0.0,
+                 throttle_codes=(4, 17, 613), app_limit=None):
+        self.users = users
+        self.friends = friends
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.throttle_codes = tuple(throttle_codes)
+        self.app_limit = app_limit
+        self._calls = collections.deque()
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        params = dict(parse_qsl(environ.get('QUERY_STRING', '')))
+        if environ['REQUEST_METHOD'] == 'POST':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            body = environ['wsgi.input'].read(length).decode('utf-8')
+            params.update(parse_qsl(body))
+        path = self._strip_version(environ.get('PATH_INFO', '/'))
+        usage = self._register_call()
+        self._sleep()
+        headers = [('Content-Type', 'application/json'),
+                   ('X-App-Usage', json.dumps({'call_count': usage,
+                                               'total_time': usage,
+                                               'total_cputime': usage}))]
+        try:
+            self._maybe_fail(usage)
+            status, data = 200, self.handle(environ['REQUEST_METHOD'], path,
+                                            params)
+        except GraphError as e:
+            status, data = e.status, e.body
+        start_response('%d %s' % (status, 'OK' if status == 200 else 'Error'),
+                       headers)
+        return [json.dumps(data).encode('utf-8')]
+
+    def handle(self, method, path, params):
+        if method == 'POST' and path == '' and 'batch' in params:
+            return self.batch(json.loads(params['batch']), params)
+        if path == 'oauth/access_token':
+            return self.access_token(params)
+        if path == 'debug_token':
+            return self.debug_token(params.get('input_token', ''))
+        if path == 'me/friends':
+            return self.me_friends(params)
+        if path == 'me':
+            return self.profile(self._get_user_id(params))
+        if path == '' and 'ids' in params:
+            return dict((uid, self.profile(uid))
+                        for uid in params['ids'].split(','))
+        if path.isdigit():
+            return self.profile(path)
+        raise GraphError(404, 803, 'Unknown path components: /%s' % path)
+
+    def access_token(self, params):
+        if 'code' in params:
+            uid = self._get_user_id_from_code(params['code'])
+        elif 'fb_exchange_token' in params:
+            uid = self._parse_token(params['fb_exchange_token'])
+        elif params.get('grant_type') == 'client_credentials':
+            return {'access_token': '%s|app' % params.get('client_id'),
+                    'token_type': 'bearer'}
+        else:
+            raise GraphError(400, 100, 'Missing authorization code')
+        return {'access_token': self._make_token(uid),
+                'token_type': 'bearer',
+                'expires_in': TOKEN_LIFETIME}
+
+    def debug_token(self, token):
+        try:
+            uid = self._parse_token(token)
+        except GraphError:
+            return {'data': {'is_valid': False, 'error': {
+                'code': 190, 'message': 'Invalid OAuth access token.'}}}
+        return {'data': {
+            'app_id': '1',
+            'is_valid': True,
+            'user_id': uid,
+            'issued_at': int(time.time()),
+            'expires_at': int(time.time()) + TOKEN_LIFETIME,
+            'scopes': SCOPES,
+        }}
+
+    def profile(self, uid):
+        return {
+            'id': str(uid),
+            'first_name': 'User',
+            'last_name': str(uid),
+            'name': 'User %s' % uid,
+            'email': 'user%s@example.com' % uid,
+        }
+
+    def me_friends(self, params):
+        uid = int(self._get_user_id(params))
+        limit = int(params.get('limit', 25))
+        start = int(base64.b64decode(params['after'].encode('ascii'))
+                    if 'after' in params else 0)
+        end = min(start + limit, self.friends)
+        data = [{'id': str((uid + (i + 1) * 7919) % self.users),
+                 'name': 'Friend %d' % i} for i in range(start, end)]
+        after = base64.b64encode(str(end).encode('ascii')).decode('ascii')
+        paging = {'cursors': {'after': after}}
+        if end < self.friends:
+            next_params = dict(params, after=after)
+            paging['next'] = 'me/friends?' + urlencode(next_params)
+        return {'data': data, 'paging': paging,
+                'summary': {'total_count': self.friends}}
+
+    def batch(self, requests, params):
+        responses = []
+        for request in requests:
+            relative_url = request.get('relative_url', '')
+            path, _, query = relative_url.partition('?')
+            item_params = dict(parse_qsl(query))
+            item_params.setdefault('access_token', params.get('access_token'))
+            try:
+                status = 200
+                body = self.handle(request.get('method', 'GET'),
+                                   self._strip_version(path), item_params)
+            except GraphError as e:
+                status, body = e.status, e.body
+            responses.append({'code': status, 'headers': [],
+                              'body': json.dumps(body)})
+        return responses
+
+    def _register_call(self):
+        if not self.app_limit:
+            return 0
+        now = time.time()
+        with self._lock:
+            self._calls.append(now)
+            while self._calls and self._calls[0] < now - 60:
+                self._calls.popleft()
+            return int(len(self._calls) * 100 / self.app_limit)
+
+    def _sleep(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def _maybe_fail(self, usage):
+        if usage >= 100:
+            raise GraphError(403, 4, THROTTLING_MESSAGES[4])
+        if self.throttle_codes and random.random() < self.throttle_rate:
+            code = random.choice(self.throttle_codes)
+            raise GraphError(403, code, THROTTLING_MESSAGES.get(
+                code, 'Rate limit reached'))
+        if random.random() < self.error_rate:
+            raise GraphError(500, 2, 'Service temporarily unavailable',
+                             is_transient=True)
+
+    @staticmethod
+    def _strip_version(path):
+        path = path.strip('/')
+        head, _, tail = path.partition('/')
+        if head.startswith('v') and head[1:].replace('.', '').isdigit():
+            return tail
+        return path
+
+    def _get_user_id(self, params):
+        return self._parse_token(params.get('access_token', ''))
+
+    def _get_user_id_from_code(self, code):
+        if code.isdigit():
+            return code
+        return str(random.randrange(self.users))
+
+    @staticmethod
+    def _make_token(uid):
+        return '%s-%s-%x' % (TOKEN_PREFIX, uid, random.getrandbits(64))
+
+    @staticmethod
+    def _parse_token(token):
+        parts = token.split('-')
+        if len(parts) != 3 or parts[0] != TOKEN_PREFIX:
+            raise GraphError(400, 190, 'Invalid OAuth access token.')
+        return parts[1]
+
+
+class ThreadingWSGIServer(ThreadingMixIn, simple_server.WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def make_server(host, port, app):
+    return simple_server.make_server(host, port, app,
+                                     server_class=ThreadingWSGIServer,
+                                     handler_class=QuietHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Facebook Graph API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--friends', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every response.')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Random extra seconds up to this value.')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-codes', type=int, nargs='+',
+                        default=[4, 17, 613])
+    parser.add_argument('--app-limit', type=int, default=None,
+                        help='Calls per minute reported as 100%% usage.')
+    args = parser.parse_args()
+    app = FakeGraph(users=args.users, friends=args.friends,
+                    latency=args.latency, jitter=args.jitter,
+                    error_rate=args.error_rate,
+                    throttle_rate=args.throttle_rate,
+                    throttle_codes=args.throttle_codes,
+                    app_limit=args.app_limit)
+    server = make_server(args.host, args.port, app)
+    print('Fake Graph API listening on http://%s:%d' % (args.host, args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
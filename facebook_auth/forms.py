@@ -1,8 +1,9 @@
-import copy
 from datetime import datetime
 
 from django import forms
 from django.utils import timezone
+from django.utils.encoding import force_text
+from django.utils.six import string_types
 
 
 class ParsedResponse(object):
@@ -12,42 +13,6 @@ class ParsedResponse(object):
         self.errors = errors
 
 
-class ListField(forms.MultiValueField):
-    def clean(self, value):
-        if hasattr(value, '__len__'):
-            self.fields = [forms.CharField(required=False)
-                           for _ in range(len(value))]
-        return super(ListField, self).clean(value)
-
-    def compress(self, data_list):
-        return data_list
-
-
-class TokenInformationForm(forms.Form):
-    user_id = forms.CharField()
-    token = forms.CharField()
-    expires_at = forms.CharField()
-    token_is_valid = forms.BooleanField()
-    scopes = ListField(required=False)
-
-    def __init__(self, initial, *args, **kwargs):
-        super(TokenInformationForm, self).__init__(initial, *args, **kwargs)
-        initial['token_is_valid'] = initial.get('is_valid', False)
-
-    def clean_token_is_valid(self):
-        if 'token_is_valid' not in self.cleaned_data:
-            raise forms.ValidationError('No token status in response.')
-        is_valid = self.cleaned_data['token_is_valid']
-        if not is_valid:
-            raise forms.ValidationError('Token is invalid.')
-        return is_valid
-
-    def clean_expires_at(self):
-        timestamp = self.data['expires_at']
-        naive = datetime.fromtimestamp(int(timestamp))
-        return naive.replace(tzinfo=timezone.utc)
-
-
 class FacebookResponseError(Exception):
     def __init__(self, errors):
         super(FacebookResponseError, self).__init__()
@@ -62,14 +27,80 @@ def parse_facebook_response(raw_response, token):
 
 
 def try_to_parse_facebook_response(raw_response, token):
+    data = _get_response_data(raw_response)
+    errors = {}
+    parsed_data = {}
+    if token in _EMPTY_VALUES:
+        errors['token'] = [_REQUIRED_MESSAGE]
+    else:
+        parsed_data['token'] = force_text(token)
+    for field, parse in _FIELD_PARSERS:
+        try:
+            parsed_data[field] = parse(data)
+        except forms.ValidationError as e:
+            errors[field] = e.messages
+    if errors:
+        raise FacebookResponseError(errors)
+    return ParsedResponse(parsed_data, True, None)
+
+
+def _get_response_data(raw_response):
     if not isinstance(raw_response, dict):
         raise FacebookResponseError(['Facebook response should be dict.'])
-    data = copy.deepcopy(raw_response.get('data', {}))
+    data = raw_response.get('data', {})
     if not isinstance(data, dict):
         raise FacebookResponseError(['Facebook data should be dict.'])
-    data['token'] = token
-    form = TokenInformationForm(data)
-    if form.is_valid():
-        return ParsedResponse(form.cleaned_data, True, None)
-    else:
-        raise FacebookResponseError(form.errors)
+    return data
+
+
+_EMPTY_VALUES = (None, '', [], (), {})
+_REQUIRED_MESSAGE = 'This field is required.'
+
+
+def _parse_required_text(data, field):
+    value = data.get(field)
+    if value in _EMPTY_VALUES:
+        raise forms.ValidationError(_REQUIRED_MESSAGE)
+    return force_text(value)
+
+
+def _parse_user_id(data):
+    return _parse_required_text(data, 'user_id')
+
+
+def _parse_expires_at(data):
+    _parse_required_text(data, 'expires_at')
+    try:
+        naive = datetime.fromtimestamp(int(data['expires_at']))
+    except (TypeError, ValueError, OverflowError, OSError):
+        raise forms.ValidationError('Invalid timestamp.')
+    return naive.replace(tzinfo=timezone.utc)
+
+
+def _parse_token_is_valid(data):
+    value = data.get('is_valid', False)
+    if isinstance(value, string_types) and value.lower() in ('false', '0'):
+        value = False
+    if not value:
+        raise forms.ValidationError(_REQUIRED_MESSAGE)
+    return True
+
+
+def _parse_scopes(data):
+    value = data.get('scopes')
+    if not value:
+        return []
+    if not isinstance(value, (list, tuple)):
+        raise forms.ValidationError('Enter a list of values.')
+    if all(scope in _EMPTY_VALUES for scope in value):
+        return []
+    return [u'' if scope in _EMPTY_VALUES else force_text(scope)
+            for scope in value]
+
+
+_FIELD_PARSERS = (
+    ('user_id', _parse_user_id),
+    ('expires_at', _parse_expires_at),
+    ('token_is_valid', _parse_token_is_valid),
+    ('scopes', _parse_scopes),
+)
@@ -1,12 +1,131 @@
+import logging
+import os
+import time
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+from django import db
 from django.core.management.base import BaseCommand
+from django.utils import timezone
 
 from facebook_auth import models
+from facebook_auth.facepy_wrapper import usage
+
+logger = logging.getLogger(__name__)
+
+MAX_REQUEUES = 3
 
 
 class Command(BaseCommand):
+    help = 'Debug tokens of all users with Celery or in worker threads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            dest='chunk_size')
+        parser.add_argument(
+            '--workers', type=int, default=0, dest='workers',
+            help='Debug tokens in this many threads instead of Celery.')
+        parser.add_argument(
+            '--checkpoint', dest='checkpoint',
+            help='File storing last processed user id to resume from.')
+        parser.add_argument(
+            '--expiring-within', type=int, dest='expiring_within',
+            help='Only users with tokens expiring within this many days.')
+        parser.add_argument(
+            '--never-debugged', action='store_true', dest='never_debugged',
+            help='Only users with tokens without expiration date.')
+
     def handle(self, *args, **options):
-        users_ids = (models.UserToken.objects.distinct('provider_user_id')
-                     .values_list('provider_user_id', flat=True))
-        for user_id in users_ids:
-            models.debug_all_tokens_for_user.delay(user_id)
-            self.stdout.write('Debugging user "%s"' % user_id)
+        self.verbosity = options.get('verbosity', 1)
+        self.checkpoint = options['checkpoint']
+        tokens = self.get_tokens(options)
+        pool = ThreadPool(options['workers']) if options['workers'] else None
+        processed = errors = 0
+        start = time.time()
+        try:
+            for users_ids in self.iter_users_ids(tokens,
+                                                 options['chunk_size']):
+                if pool:
+                    errors += self.debug_in_pool(pool, users_ids)
+                else:
+                    for user_id in users_ids:
+                        models.debug_all_tokens_for_user.delay(user_id)
+                        if self.verbosity > 1:
+                            self.stdout.write('Debugging user "%s"' % user_id)
+                processed += len(users_ids)
+                self.write_checkpoint(users_ids[-1])
+                elapsed = time.time() - start
+                self.stdout.write(
+                    'Processed %d users (%d errors, %.1f users/s)' %
+                    (processed, errors, processed / max(elapsed, 0.001)))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def debug_in_pool(self, pool, users_ids):
+        """Debug tokens in threads, requeueing retried and postponed users.
+
+        Returns number of users whose tokens were not debugged.
+        """
+        errors = 0
+        for _ in range(MAX_REQUEUES + 1):
+            results = pool.map(_debug_user_tokens, users_ids)
+            errors += results.count(False)
+            users_ids = [user_id for user_id, result
+                         in zip(users_ids, results)
+                         if result in (models.TOKENS_RETRY,
+                                       models.TOKENS_POSTPONED)]
+            if not users_ids:
+                return errors
+            if models.TOKENS_POSTPONED in results:
+                time.sleep(usage.GOVERNOR.get_retry_after(
+                    usage.PRIORITY_LOW))
+        logger.warning('Giving up debugging tokens of %d users.',
+                       len(users_ids))
+        return errors + len(users_ids)
+
+    def get_tokens(self, options):
+        tokens = models.UserToken.objects.filter(deleted=False)
+        if options['expiring_within'] is not None:
+            until = timezone.now() + timedelta(days=options['expiring_within'])
+            tokens = tokens.filter(expiration_date__lte=until)
+        if options['never_debugged']:
+            tokens = tokens.filter(expiration_date__isnull=True)
+        return tokens
+
+    def iter_users_ids(self, tokens, chunk_size):
+        last_user_id = self.read_checkpoint()
+        while True:
+            chunk = tokens
+            if last_user_id is not None:
+                chunk = chunk.filter(provider_user_id__gt=last_user_id)
+            users_ids = list(chunk.order_by('provider_user_id')
+                             .values_list('provider_user_id', flat=True)
+                             .distinct()[:chunk_size])
+            if not users_ids:
+                return
+            yield users_ids
+            last_user_id = users_ids[-1]
+
+    def read_checkpoint(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as checkpoint:
+                return checkpoint.read().strip() or None
+        return None
+
+    def write_checkpoint(self, user_id):
+        if self.checkpoint:
+            with open(self.checkpoint, 'w') as checkpoint:
+                checkpoint.write(user_id)
+
+
+def _debug_user_tokens(user_id):
+    try:
+        return models.debug_user_tokens(user_id)
+    except Exception:
+        logger.exception('Debugging tokens of user failed.',
+                         extra={'provider_user_id': user_id})
+        return False
+    finally:
+        db.connections.close_all()
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from facebook_auth import models
+
+
+class Command(BaseCommand):
+    help = 'Schedule synchronisation of app friends for all users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=100,
+                            dest='chunk_size')
+
+    def handle(self, *args, **options):
+        count = models.schedule_app_friends_sync(options['chunk_size'])
+        self.stdout.write('Scheduled app friends sync of %d users' % count)
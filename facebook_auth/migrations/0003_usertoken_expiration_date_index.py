@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facebook_auth', '0002_usertoken_best_token_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='usertoken',
+            name='expiration_date',
+            field=models.DateTimeField(default=None, null=True, db_index=True, blank=True),
+        ),
+    ]
@@ -1,19 +1,24 @@
 import collections
 import json
 import logging
+import random
 from datetime import timedelta
 from cached_property import cached_property
 
 try:
     from urllib.error import HTTPError
+    from urllib.parse import urlencode
 except ImportError:
     from urllib2 import HTTPError
+    from urllib import urlencode
 
 
 from django.conf import settings
 from django.core.cache import cache
 from django.contrib.auth import models as auth_models
+from django.db import IntegrityError
 from django.db import models
+from django.db import transaction
 from django.dispatch import receiver
 from django.utils import timezone
 
@@ -21,11 +26,38 @@ from celery import task
 from facepy import exceptions
 
 from facebook_auth import forms
+from facebook_auth import signals
+from facebook_auth import token_cache
 from facebook_auth import utils
+from facebook_auth.facepy_wrapper import usage
 from facebook_auth.facepy_wrapper.utils import TokenParsingError
 
 logger = logging.getLogger(__name__)
 
+BATCH_DEBUG_TOKENS = getattr(settings, 'FACEBOOK_AUTH_BATCH_DEBUG_TOKENS',
+                             False)
+TOKEN_CACHE = token_cache.get_token_cache()
+FRIENDS_PAGE_SIZE = getattr(settings, 'FACEBOOK_AUTH_FRIENDS_PAGE_SIZE', 500)
+FRIENDS_LIMIT = getattr(settings, 'FACEBOOK_AUTH_FRIENDS_LIMIT', None)
+FRIENDS_QUERY_CHUNK_SIZE = 1000
+FRIENDS_SYNC_PERIOD = getattr(settings, 'FACEBOOK_AUTH_FRIENDS_SYNC_PERIOD',
+                              timedelta(hours=20))
+FRIENDS_SYNC_RATE = getattr(settings, 'FACEBOOK_AUTH_FRIENDS_SYNC_RATE', 10)
+FRIENDS_SYNC_BUCKET = utils.SharedTokenBucket('friends_sync',
+                                              FRIENDS_SYNC_RATE)
+TOKEN_REFRESH_WINDOW = getattr(settings, 'FACEBOOK_AUTH_TOKEN_REFRESH_WINDOW',
+                               timedelta(days=7))
+TOKEN_REFRESH_SPREAD = getattr(settings, 'FACEBOOK_AUTH_TOKEN_REFRESH_SPREAD',
+                               timedelta(hours=1))
+TOKEN_REFRESH_PERIOD = getattr(settings, 'FACEBOOK_AUTH_TOKEN_REFRESH_PERIOD',
+                               timedelta(days=1))
+TOKEN_REFRESH_BATCH_SIZE = 500
+INVALID_TOKEN_CODE = 190
+DEFERRED_PROFILE = getattr(settings, 'FACEBOOK_AUTH_DEFERRED_PROFILE', False)
+USER_CACHE_VERSION = getattr(settings, 'FACEBOOK_AUTH_USER_CACHE_VERSION', 1)
+PROFILE_FRESHNESS = getattr(settings, 'FACEBOOK_AUTH_PROFILE_FRESHNESS',
+                            timedelta(days=1))
+
 
 class FacebookUser(auth_models.User):
     user_id = models.BigIntegerField(unique=True)
@@ -60,35 +92,90 @@ class FacebookUser(auth_models.User):
 
     @property
     def friends(self):
-        response = utils.get_from_graph_api(self.graph, "me/friends")
-        if 'data' in response:
-            return response['data']
-        else:
-            logger.warning("OpenGraph error: %s" % response)
-            return []
-
-    def update_app_friends(self):
-        friends = self.friends
-        friends_ids = [f['id'] for f in friends]
-        existing_friends = self.app_friends.all().values_list(
-            'user_id', flat=True)
-        new_friends = FacebookUser.objects.filter(
-            user_id__in=friends_ids).exclude(user_id__in=existing_friends)
-        removed_friends = self.app_friends.exclude(user_id__in=friends_ids)
-        self.app_friends.add(*new_friends)
-        self.app_friends.remove(*removed_friends)
+        return list(self.iter_friends())
+
+    def iter_friends(self, page_size=FRIENDS_PAGE_SIZE, limit=FRIENDS_LIMIT,
+                     bucket=None):
+        count = 0
+        pages = utils.iter_pages_from_graph_api(self.graph, "me/friends",
+                                                bucket=bucket,
+                                                limit=page_size)
+        for response in pages:
+            if 'data' not in response:
+                logger.warning("OpenGraph error: %s" % response)
+                return
+            for friend in response['data']:
+                if limit is not None and count >= limit:
+                    return
+                yield friend
+                count += 1
+
+    def update_app_friends(self, bucket=None):
+        """Synchronise app_friends with Facebook friends.
+
+        Works on primary keys of the through model in both directions of the
+        symmetrical relation, so m2m_changed is not sent. Bucket is acquired
+        before every friends page request.
+        """
+        friends_ids = set(int(f['id'])
+                          for f in self.iter_friends(bucket=bucket))
+        friends_pks = set()
+        for chunk in utils.chunks(friends_ids, FRIENDS_QUERY_CHUNK_SIZE):
+            friends_pks.update(FacebookUser.objects.filter(user_id__in=chunk)
+                               .values_list('pk', flat=True))
+        friends_pks.discard(self.pk)
+        try:
+            self._set_app_friends(friends_pks)
+        except IntegrityError:
+            # Sync of a mutual friend inserted the same rows concurrently.
+            logger.info('App friends changed during sync, retrying.')
+            self._set_app_friends(friends_pks)
+
+    def _set_app_friends(self, friends_pks):
+        through = FacebookUser.app_friends.through
+        outgoing, incoming = set(), set()
+        rows = (through.objects
+                .filter(models.Q(from_facebookuser_id=self.pk) |
+                        models.Q(to_facebookuser_id=self.pk))
+                .values_list('from_facebookuser_id', 'to_facebookuser_id'))
+        for from_pk, to_pk in rows:
+            if from_pk == self.pk:
+                outgoing.add(to_pk)
+            if to_pk == self.pk:
+                incoming.add(from_pk)
+
+        removed_pks = (outgoing | incoming) - friends_pks
+        new_rows = (
+            [through(from_facebookuser_id=self.pk, to_facebookuser_id=pk)
+             for pk in friends_pks - outgoing] +
+            [through(from_facebookuser_id=pk, to_facebookuser_id=self.pk)
+             for pk in friends_pks - incoming]
+        )
+        with transaction.atomic():
+            for chunk in utils.chunks(removed_pks, FRIENDS_QUERY_CHUNK_SIZE):
+                through.objects.filter(
+                    models.Q(from_facebookuser_id=self.pk,
+                             to_facebookuser_id__in=chunk) |
+                    models.Q(from_facebookuser_id__in=chunk,
+                             to_facebookuser_id=self.pk)).delete()
+            through.objects.bulk_create(new_rows,
+                                        batch_size=FRIENDS_QUERY_CHUNK_SIZE)
 
 
 class UserToken(models.Model):
     provider_user_id = models.CharField(max_length=255)
     token = models.TextField(unique=True)
     granted_at = models.DateTimeField(auto_now_add=True)
-    expiration_date = models.DateTimeField(null=True, blank=True, default=None)
+    expiration_date = models.DateTimeField(null=True, blank=True, default=None,
+                                           db_index=True)
     deleted = models.BooleanField(default=False)
 
     class Meta:
         verbose_name = 'User token'
         verbose_name_plural = 'User tokens'
+        index_together = [
+            ('provider_user_id', 'deleted', 'expiration_date', 'granted_at'),
+        ]
 
 
 class TokenDebugException(Exception):
@@ -96,6 +183,9 @@ class TokenDebugException(Exception):
 
 
 class UserTokenManager(object):
+    WILDCARDED_TOKEN_FRESHNESS = timedelta(seconds=30)
+    INSERT_TOKENS_CHUNK_SIZE = 500
+
     @staticmethod
     def insert_token(provider_user_id, token, expiration_date=None):
         provider_user_id = str(provider_user_id)
@@ -106,43 +196,164 @@ class UserTokenManager(object):
         if not created:
             obj.expiration_date = expiration_date
             obj.save()
+        TOKEN_CACHE.delete(provider_user_id)
 
         if obj.provider_user_id != provider_user_id:
-            extra = {'object_provider_user_id': obj.provider_user_id,
-                     'provider_user_id': provider_user_id,
-                     'provider_user_id_type': type(provider_user_id)}
-            logger.warning('Got different provider_user_id for token.',
-                           extra=extra)
+            UserTokenManager._warn_provider_user_id_mismatch(
+                obj.provider_user_id, provider_user_id)
 
-    @staticmethod
-    def get_access_token(provider_user_id):
-        eldest_wildcarded = timezone.now() - timezone.timedelta(seconds=30)
-        related_tokens = UserToken.objects.filter(
-            provider_user_id=provider_user_id, deleted=False)
+    @classmethod
+    def insert_tokens(cls, tokens):
+        """Insert many (provider_user_id, token, expiration_date) tuples.
+
+        Instead of post_save for every token, tokens_inserted signal is sent
+        once per provider user who got new tokens.
+        """
+        touched = set()
+        created = set()
+        for chunk in utils.chunks(tokens, cls.INSERT_TOKENS_CHUNK_SIZE):
+            chunk_touched, chunk_created = cls._insert_tokens_chunk(chunk)
+            touched.update(chunk_touched)
+            created.update(chunk_created)
+        for provider_user_id in touched:
+            TOKEN_CACHE.delete(provider_user_id)
+        for provider_user_id in created:
+            signals.tokens_inserted.send(sender=UserToken,
+                                         provider_user_id=provider_user_id)
+
+    @classmethod
+    def _insert_tokens_chunk(cls, chunk):
+        rows = collections.OrderedDict()
+        for provider_user_id, token, expiration_date in chunk:
+            rows[token] = (str(provider_user_id), expiration_date)
+        existing = dict(UserToken.objects.filter(token__in=list(rows))
+                        .values_list('token', 'provider_user_id'))
+        new_tokens = [
+            UserToken(provider_user_id=provider_user_id, token=token,
+                      expiration_date=expiration_date)
+            for token, (provider_user_id, expiration_date) in rows.items()
+            if token not in existing
+        ]
         try:
-            return (related_tokens
-                    .filter(expiration_date__isnull=True,
-                            granted_at__gte=eldest_wildcarded)
-                    .latest('granted_at'))
-        except UserToken.DoesNotExist:
-            return (related_tokens
-                    .exclude(expiration_date__isnull=True)
-                    .latest('expiration_date'))
+            with transaction.atomic():
+                UserToken.objects.bulk_create(new_tokens)
+        except IntegrityError:
+            logger.info('Tokens inserted concurrently, inserting one by one.')
+            for obj in new_tokens:
+                cls.insert_token(obj.provider_user_id, obj.token,
+                                 obj.expiration_date)
+
+        expiration_dates = []
+        for token, object_provider_user_id in existing.items():
+            provider_user_id, expiration_date = rows[token]
+            expiration_dates.append(models.When(
+                token=token, then=models.Value(expiration_date)))
+            if object_provider_user_id != provider_user_id:
+                cls._warn_provider_user_id_mismatch(object_provider_user_id,
+                                                    provider_user_id)
+        if expiration_dates:
+            (UserToken.objects.filter(token__in=list(existing))
+             .update(expiration_date=models.Case(
+                 *expiration_dates,
+                 default=models.F('expiration_date'),
+                 output_field=models.DateTimeField())))
+
+        touched = set(provider_user_id for provider_user_id, _
+                      in rows.values())
+        touched.update(existing.values())
+        created = set(obj.provider_user_id for obj in new_tokens)
+        return touched, created
 
     @staticmethod
-    def invalidate_access_token(token):
-        UserToken.objects.filter(token=token).update(deleted=True)
+    def _warn_provider_user_id_mismatch(object_provider_user_id,
+                                        provider_user_id):
+        extra = {'object_provider_user_id': object_provider_user_id,
+                 'provider_user_id': provider_user_id,
+                 'provider_user_id_type': type(provider_user_id)}
+        logger.warning('Got different provider_user_id for token.',
+                       extra=extra)
+
+    @classmethod
+    def get_access_token(cls, provider_user_id):
+        token = TOKEN_CACHE.get(provider_user_id)
+        if token is None:
+            token = cls._get_access_token(provider_user_id)
+            if token.expiration_date is None:
+                fresh_until = token.granted_at + cls.WILDCARDED_TOKEN_FRESHNESS
+                timeout = (fresh_until - timezone.now()).total_seconds()
+            else:
+                timeout = None
+            if timeout is None or timeout > 0:
+                TOKEN_CACHE.set(provider_user_id, token, timeout)
+        return token
+
+    @classmethod
+    def _get_access_token(cls, provider_user_id):
+        """Return the best token of user.
+
+        Fresh wildcarded tokens (without expiration date) come first, latest
+        granted first. Otherwise the latest expiring token is returned.
+        """
+        eldest_wildcarded = timezone.now() - cls.WILDCARDED_TOKEN_FRESHNESS
+        fresh_wildcarded = models.Q(expiration_date__isnull=True,
+                                    granted_at__gte=eldest_wildcarded)
+        expiring = models.Q(expiration_date__isnull=False)
+        is_wildcarded = models.Case(
+            models.When(expiration_date__isnull=True, then=models.Value(1)),
+            default=models.Value(0),
+            output_field=models.IntegerField())
+        tokens = (UserToken.objects
+                  .filter(provider_user_id=provider_user_id, deleted=False)
+                  .filter(fresh_wildcarded | expiring)
+                  .annotate(is_wildcarded=is_wildcarded)
+                  .order_by('-is_wildcarded', '-expiration_date',
+                            '-granted_at')[:1])
+        for token in tokens:
+            return token
+        raise UserToken.DoesNotExist
+
+    @classmethod
+    def invalidate_access_token(cls, token):
+        cls.invalidate_tokens([token])
+
+    @staticmethod
+    def invalidate_tokens(tokens, provider_user_id=None):
+        """Mark tokens as deleted.
+
+        With provider_user_id only tokens of that user are invalidated in
+        a single UPDATE. Otherwise owners are looked up first to drop their
+        cached tokens, unless TOKEN_CACHE caches nothing.
+        """
+        tokens = UserToken.objects.filter(token__in=list(tokens))
+        if provider_user_id is None and not TOKEN_CACHE.caches:
+            provider_user_ids = []
+        elif provider_user_id is None:
+            provider_user_ids = set(
+                tokens.values_list('provider_user_id', flat=True))
+        else:
+            provider_user_ids = [str(provider_user_id)]
+            tokens = tokens.filter(provider_user_id=provider_user_ids[0])
+        tokens.update(deleted=True)
+        for provider_user_id in provider_user_ids:
+            TOKEN_CACHE.delete(provider_user_id)
 
 
 class FacebookTokenManager(object):
     DEBUG_ALL_USER_TOKENS_PERIOD = getattr(settings, 'FACEBOOK_AUTH_DEBUG_ALL_USER_TOKENS_PERIOD', timedelta(minutes=5))
+    DEBUG_TOKENS_BATCH_SIZE = 50
     TokenInfo = collections.namedtuple('TokenInfo',
                                        ['user', 'expires', 'token'])
 
     @staticmethod
-    def insert_token(access_token, user_id, token_expiration_date=None):
+    def insert_token(access_token, user_id, token_expiration_date=None,
+                     long_lived_token=None):
         token_manager = UserTokenManager()
-        if getattr(settings, 'REQUEST_LONG_LIVED_ACCESS_TOKEN', False):
+        if long_lived_token is not None:
+            token_manager.insert_token(
+                user_id, long_lived_token.access_token,
+                FacebookTokenManager.convert_expiration_seconds_to_date(
+                    long_lived_token.expires_in_seconds))
+        elif getattr(settings, 'REQUEST_LONG_LIVED_ACCESS_TOKEN', False):
             insert_extended_token.delay(access_token, user_id)
         token_manager.insert_token(user_id, access_token,
                                    token_expiration_date)
@@ -162,6 +373,49 @@ class FacebookTokenManager(object):
     def debug_token(self, token):
         graph = utils.get_application_graph()
         response = graph.get('/debug_token', input_token=token)
+        return self._handle_debug_response(response, token)
+
+    def debug_tokens(self, tokens):
+        """Debug tokens using Graph batch requests.
+
+        Returns list of (token, result) pairs, where result is TokenInfo or
+        TokenDebugException instance. Like debug_token, raises errors other
+        than invalid token, so tokens are not deleted during outages.
+        """
+        graph = utils.get_application_graph()
+        results = []
+        for chunk in utils.chunks(tokens, self.DEBUG_TOKENS_BATCH_SIZE):
+            requests = [self._get_debug_batch_request(token)
+                        for token in chunk]
+            for token, response in zip(chunk, graph.batch(requests)):
+                self._check_batch_response(response)
+                try:
+                    result = self._handle_debug_response(response, token)
+                except TokenDebugException as e:
+                    result = e
+                results.append((token, result))
+        return results
+
+    @staticmethod
+    def _get_debug_batch_request(token):
+        return {
+            'method': 'GET',
+            'relative_url': 'debug_token?' + urlencode({'input_token': token}),
+        }
+
+    @staticmethod
+    def _check_batch_response(response):
+        if response is None:
+            raise exceptions.FacepyError('Batch request did not finish.')
+        if isinstance(response, Exception):
+            if getattr(response, 'code', None) == INVALID_TOKEN_CODE:
+                return
+            raise response
+
+    def _handle_debug_response(self, response, token):
+        if isinstance(response, Exception):
+            raise TokenDebugException('Facebook error.',
+                                      {'errors': [str(response)]})
         parsed_response = forms.parse_facebook_response(response, token)
         if parsed_response.is_valid:
             data = parsed_response.parsed_data
@@ -173,8 +427,11 @@ class FacebookTokenManager(object):
 
     def _update_scope(self, data):
         if 'scopes' in data:
-            (FacebookUser.objects.filter(user_id=data['user_id'])
-             .update(scope=','.join(data['scopes'])))
+            users = FacebookUser.objects.filter(user_id=data['user_id'])
+            pks = list(users.values_list('pk', flat=True))
+            users.update(scope=','.join(data['scopes']))
+            # update() sends no post_save, so cached users are dropped here.
+            cache.delete_many([get_user_cache_key(pk) for pk in pks])
 
     def get_token_info(self, response_data):
         return self.TokenInfo(token=response_data['token'],
@@ -227,8 +484,58 @@ def dispatch_engines_run(sender, instance, created, **kwargs):
         FacebookTokenManager.debug_all_user_tokens(instance.provider_user_id)
 
 
-@task()
-def debug_all_tokens_for_user(user_id):
+@receiver(signals.tokens_inserted, sender=UserToken)
+def dispatch_engines_run_for_inserted_tokens(sender, provider_user_id,
+                                             **kwargs):
+    FacebookTokenManager.debug_all_user_tokens(provider_user_id)
+
+
+@receiver(models.signals.post_save, sender=UserToken)
+def invalidate_cached_token(sender, instance, **kwargs):
+    TOKEN_CACHE.delete(instance.provider_user_id)
+
+
+def get_user_cache_key(pk):
+    return 'facebook_auth_user-{}-{}'.format(USER_CACHE_VERSION, pk)
+
+
+@receiver(models.signals.post_save, sender=FacebookUser)
+@receiver(models.signals.post_delete, sender=FacebookUser)
+@receiver(models.signals.post_save, sender=auth_models.User)
+@receiver(models.signals.post_delete, sender=auth_models.User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    cache.delete(get_user_cache_key(instance.pk))
+
+
+def _debug_tokens(manager, tokens):
+    if BATCH_DEBUG_TOKENS:
+        return manager.debug_tokens(tokens)
+    results = []
+    for token in tokens:
+        try:
+            results.append((token, manager.debug_token(token)))
+        except TokenDebugException as e:
+            results.append((token, e))
+    return results
+
+
+TOKENS_DEBUGGED = 'debugged'
+TOKENS_RETRY = 'retry'
+TOKENS_POSTPONED = 'postponed'
+
+
+def debug_user_tokens(user_id):
+    """Debug all tokens of user and delete all but the best one.
+
+    Returns TOKENS_POSTPONED if Graph API usage is too high and TOKENS_RETRY
+    if a new best token arrived meanwhile, otherwise TOKENS_DEBUGGED.
+    """
+    try:
+        usage.GOVERNOR.acquire(usage.PRIORITY_LOW)
+    except usage.UsageLimitExceeded:
+        logger.info('Graph API usage too high, postponing'
+                    ' debug_all_tokens_for_user.')
+        return TOKENS_POSTPONED
     manager = FacebookTokenManager()
     token_manager = UserTokenManager()
     user_tokens = list(
@@ -236,16 +543,17 @@ def debug_all_tokens_for_user(user_id):
         .filter(provider_user_id=user_id, deleted=False)
         .values_list('token', flat=True)
     )
-    for token in user_tokens:
-        try:
-            data = manager.debug_token(token)
-        except TokenDebugException:
+    invalid_tokens = []
+    for token, data in _debug_tokens(manager, user_tokens):
+        if isinstance(data, TokenDebugException):
             logger.info('Invalid access token')
-            token_manager.invalidate_access_token(token)
+            invalid_tokens.append(token)
         else:
             token_manager.insert_token(user_id, data.token, data.expires)
+    if invalid_tokens:
+        token_manager.invalidate_tokens(invalid_tokens, user_id)
     try:
-        best_token = token_manager.get_access_token(user_id)
+        best_token = token_manager._get_access_token(user_id)
     except UserToken.DoesNotExist:
         logger.info("Best token was deleted by other process.")
     else:
@@ -254,11 +562,135 @@ def debug_all_tokens_for_user(user_id):
                 'New best token has arrived.'
                 'Retrying debug_all_tokens_for_user.'
             )
-            debug_all_tokens_for_user.retry(args=[user_id],
-                                            countdown=45)
+            return TOKENS_RETRY
         else:
             logger.info('Deleting user tokens except best one.')
-            tokens_to_delete = sorted(user_tokens)
+            tokens_to_delete = set(user_tokens)
             tokens_to_delete.remove(best_token.token)
-            for token in tokens_to_delete:
-                token_manager.invalidate_access_token(token)
+            if tokens_to_delete:
+                token_manager.invalidate_tokens(tokens_to_delete, user_id)
+    return TOKENS_DEBUGGED
+
+
+@task()
+def debug_all_tokens_for_user(user_id):
+    result = debug_user_tokens(user_id)
+    if result == TOKENS_POSTPONED:
+        debug_all_tokens_for_user.apply_async(
+            args=[user_id],
+            countdown=usage.GOVERNOR.get_retry_after(usage.PRIORITY_LOW))
+    elif result == TOKENS_RETRY:
+        debug_all_tokens_for_user.retry(args=[user_id], countdown=45)
+
+
+def _get_friends_synced_key(pk):
+    return 'facebook_auth_app_friends_synced-{}'.format(pk)
+
+
+def schedule_app_friends_sync(chunk_size=100):
+    users_pks = (FacebookUser.objects.order_by('pk')
+                 .values_list('pk', flat=True).iterator())
+    count = 0
+    for chunk in utils.chunks(users_pks, chunk_size):
+        update_app_friends_for_users.delay(chunk)
+        count += len(chunk)
+    return count
+
+
+@task()
+def update_app_friends_for_users(users_pks):
+    keys = dict((_get_friends_synced_key(pk), pk) for pk in users_pks)
+    synced = set(keys[key] for key in cache.get_many(list(keys)))
+    users = [user for user in FacebookUser.objects.filter(pk__in=users_pks)
+             if user.pk not in synced]
+    for i, user in enumerate(users):
+        try:
+            usage.GOVERNOR.acquire(usage.PRIORITY_LOW)
+        except usage.UsageLimitExceeded as e:
+            logger.info('Graph API usage too high, postponing app friends'
+                        ' sync.')
+            update_app_friends_for_users.apply_async(
+                args=[[u.pk for u in users[i:]]], countdown=e.retry_after)
+            return
+        try:
+            user.update_app_friends(bucket=FRIENDS_SYNC_BUCKET)
+        except UserToken.DoesNotExist:
+            logger.info('No token to update app friends.')
+        except exceptions.FacepyError as e:
+            logger.info('Updating app friends failed: %s' % e)
+        except IntegrityError:
+            logger.warning('Concurrent app friends sync conflicted.',
+                           exc_info=True)
+        cache.set(_get_friends_synced_key(user.pk), 1,
+                  FRIENDS_SYNC_PERIOD.total_seconds())
+
+
+def _get_profile_updated_key(user_id):
+    return 'facebook_auth_profile_updated-{}'.format(user_id)
+
+
+def schedule_profile_update(user_id, profile):
+    """Enqueue profile parsing unless it was done within PROFILE_FRESHNESS.
+
+    Where Django supports it, the task is enqueued after the current
+    transaction commits.
+    """
+    def schedule():
+        if cache.add(_get_profile_updated_key(user_id), 1,
+                     PROFILE_FRESHNESS.total_seconds()):
+            update_profile.delay(user_id, profile)
+
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is None:
+        schedule()
+    else:
+        on_commit(schedule)
+
+
+@task()
+def update_profile(user_id, profile):
+    from facebook_auth.backends import USER_FACTORY
+    try:
+        user = FacebookUser.objects.get(user_id=user_id)
+    except FacebookUser.DoesNotExist:
+        logger.info('User was deleted before updating profile.')
+    else:
+        USER_FACTORY.create_profile_object(profile, user)
+
+
+def _get_token_refreshed_key(pk):
+    return 'facebook_auth_token_refreshed-{}'.format(pk)
+
+
+@task()
+def refresh_expiring_tokens():
+    """Exchange tokens expiring soon for long-lived ones.
+
+    Meant to be run periodically by Celery beat. Exchanges are spread over
+    TOKEN_REFRESH_SPREAD and every token is refreshed at most once per
+    TOKEN_REFRESH_PERIOD.
+    """
+    now = timezone.now()
+    tokens = (UserToken.objects
+              .filter(deleted=False, expiration_date__gt=now,
+                      expiration_date__lte=now + TOKEN_REFRESH_WINDOW)
+              .order_by('pk')
+              .values_list('pk', 'token', 'provider_user_id'))
+    last_pk = 0
+    scheduled = 0
+    while True:
+        batch = list(tokens.filter(pk__gt=last_pk)[:TOKEN_REFRESH_BATCH_SIZE])
+        if not batch:
+            return scheduled
+        last_pk = batch[-1][0]
+        keys = [_get_token_refreshed_key(pk) for pk, _, _ in batch]
+        refreshed = cache.get_many(keys)
+        for key, (pk, token, provider_user_id) in zip(keys, batch):
+            if key in refreshed:
+                continue
+            countdown = random.uniform(0, TOKEN_REFRESH_SPREAD.total_seconds())
+            insert_extended_token.apply_async(args=[token, provider_user_id],
+                                              countdown=countdown)
+            scheduled += 1
+        cache.set_many(dict((key, 1) for key in keys if key not in refreshed),
+                       TOKEN_REFRESH_PERIOD.total_seconds())
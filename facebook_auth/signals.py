@@ -0,0 +1,3 @@
+from django import dispatch
+
+tokens_inserted = dispatch.Signal(providing_args=['provider_user_id'])
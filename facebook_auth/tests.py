@@ -8,20 +8,37 @@ except ImportError:
     MOCK_CLASS_NAME = 'mock.Mock'
 
 import collections
+import contextlib
 import datetime
+import json
+import os
+import tempfile
+import threading
+import unittest
 
+from django.core import management
 from django.core.cache import cache
+from django.db import connection
+from django.db import IntegrityError
+from django.db import transaction
 from django import test
+from django.test import utils as test_utils
+from django.utils import six
 
 from facepy.exceptions import FacebookError
 import pytz
 
+from facebook_auth import backends
 from facebook_auth.backends import _truncate as truncate
 from facebook_auth.backends import UserFactory
+from facebook_auth import fake_graph_server
 from facebook_auth import forms
 from facebook_auth.facepy_wrapper import utils as wrapper_utils
 from facebook_auth.facepy_wrapper import graph_api
+from facebook_auth.facepy_wrapper import metrics
+from facebook_auth.facepy_wrapper import usage
 from facebook_auth import models
+from facebook_auth import token_cache
 from facebook_auth import utils
 from facebook_auth import views
 
@@ -90,6 +107,28 @@ class UserFactoryTest(test.TestCase):
         self.assertEqual(user.last_name, 'a' * get_length('last_name'))
         self.assertEqual(user.email, '')
 
+    def test_created_with_unusable_password(self):
+        UserFactory()._product_user(None, {'id': '1', 'first_name': 'First'})
+        user = models.FacebookUser.objects.get(user_id=1)
+        self.assertEqual('First', user.first_name)
+        self.assertFalse(user.has_usable_password())
+
+    def test_unchanged_profile_is_not_saved(self):
+        profile = {'id': '1', 'first_name': 'First', 'last_name': 'Last'}
+        UserFactory()._product_user(None, profile)
+        with mock.patch.object(models.FacebookUser, 'save') as save:
+            UserFactory()._product_user(None, profile)
+        self.assertFalse(save.called)
+
+    def test_changed_fields_are_updated(self):
+        UserFactory()._product_user(None, {'id': '1', 'first_name': 'First',
+                                           'last_name': 'Last'})
+        with mock.patch.object(models.FacebookUser, 'save') as save:
+            UserFactory()._product_user(None, {'id': '1',
+                                               'first_name': 'Other',
+                                               'last_name': 'Last'})
+        save.assert_called_once_with(update_fields=['first_name'])
+
 
 @mock.patch('facebook_auth.utils.get_graph')
 class UserFactoryOnErrorTest(test.TestCase):
@@ -121,38 +160,289 @@ class UserFactoryOnErrorTest(test.TestCase):
         with self.assertRaises(FacebookError):
             factory.get_user("123")
 
+    @mock.patch('time.sleep')
+    def test_failing_fast_when_throttled(self, sleep, get_graph):
+        get_graph.return_value.get.side_effect = [
+            FacebookError("msg", 4),
+            {'id': '123'}]
+        with self.assertRaises(FacebookError):
+            UserFactory().get_user("123")
+        self.assertFalse(sleep.called)
+
+
+@mock.patch.object(UserFactory, 'GRAPH_IDS_CHUNK_SIZE', 2)
+@mock.patch('facebook_auth.utils.get_application_graph')
+class GetUsersByIdsTest(test.TestCase):
+    def test_chunks(self, get_application_graph):
+        models.FacebookUser.objects.create(user_id=1, username='1',
+                                           first_name='Old')
+        graph = get_application_graph.return_value
+        graph.get.side_effect = [
+            {'1': {'id': '1', 'first_name': 'New'},
+             '2': {'id': '2', 'first_name': 'Second'}},
+            {'3': {'id': '3', 'first_name': 'Third'}},
+        ]
+        users = UserFactory().get_users_by_ids([1, 2, 3, 4])
+        self.assertEqual([1, 2, 3], [user.user_id for user in users])
+        self.assertEqual(
+            ['New', 'Second', 'Third'],
+            list(models.FacebookUser.objects.order_by('user_id')
+                 .values_list('first_name', flat=True)))
+        self.assertEqual('1,2', graph.get.call_args_list[0][1]['ids'])
+        self.assertEqual('3,4', graph.get.call_args_list[1][1]['ids'])
+        self.assertFalse(users[1].has_usable_password())
+
+    def test_invalid_id_in_chunk(self, get_application_graph):
+        graph = get_application_graph.return_value
+        graph.get.side_effect = [
+            FacebookError('Invalid id', 100),
+            FacebookError('Invalid id', 100),
+            {'id': '2', 'first_name': 'Second'},
+        ]
+        users = UserFactory().get_users_by_ids([1, 2])
+        self.assertEqual([2], [user.user_id for user in users])
+        self.assertEqual('1,2', graph.get.call_args_list[0][1]['ids'])
+        self.assertEqual('1', graph.get.call_args_list[1][0][0])
+        self.assertEqual('2', graph.get.call_args_list[2][0][0])
+
+    def test_throttled_chunk_is_not_refetched(self, get_application_graph):
+        graph = get_application_graph.return_value
+        graph.get.side_effect = FacebookError('Throttled', 4)
+        with mock.patch('facebook_auth.utils.DEFAULT_RETRY_POLICY',
+                        utils.RetryPolicy(max_tries=1)):
+            with self.assertRaises(FacebookError):
+                UserFactory().get_users_by_ids([1, 2])
+        self.assertEqual(1, graph.get.call_count)
+
+
+@mock.patch('facebook_auth.backends.USER_CACHE_TIMEOUT', 60)
+class CachedGetUserTest(test.TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = models.FacebookUser.objects.create(user_id=1,
+                                                       username='1')
+        self.backend = backends.FacebookBackend()
+
+    def test_cache_hit(self):
+        self.backend.get_user(self.user.pk)
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+        self.assertEqual(self.user, user)
+
+    def test_invalidated_on_save(self):
+        self.backend.get_user(self.user.pk)
+        self.user.first_name = 'First'
+        self.user.save()
+        with self.assertNumQueries(1):
+            user = self.backend.get_user(self.user.pk)
+        self.assertEqual('First', user.first_name)
+
+    def test_invalidated_on_scope_update(self):
+        self.backend.get_user(self.user.pk)
+        models.FacebookTokenManager()._update_scope(
+            {'user_id': 1, 'scopes': ['email', 'user_friends']})
+        user = self.backend.get_user(self.user.pk)
+        self.assertEqual('email,user_friends', user.scope)
+
+    def test_missing_user_is_not_cached(self):
+        self.assertIsNone(self.backend.get_user(self.user.pk + 1))
+        self.assertIsNone(cache.get(models.get_user_cache_key(
+            self.user.pk + 1)))
+
+    @mock.patch('facebook_auth.backends.USER_CACHE_FIELDS',
+                ['username', 'user_id'])
+    def test_fields_projection(self):
+        user = self.backend.get_user(self.user.pk)
+        deferred = user.get_deferred_fields()
+        self.assertIn('first_name', deferred)
+        self.assertNotIn('username', deferred)
+        self.assertNotIn('password', deferred)
+        self.assertEqual(1, user.user_id)
+
+
+@mock.patch('facebook_auth.models.DEFERRED_PROFILE', True)
+@mock.patch('facebook_auth.models.update_profile')
+class DeferredProfileTest(test.TestCase):
+    def setUp(self):
+        cache.clear()
+        # TestCase never commits, so run on_commit callbacks at once.
+        on_commit = mock.patch.object(transaction, 'on_commit', create=True,
+                                      side_effect=lambda func: func())
+        on_commit.start()
+        self.addCleanup(on_commit.stop)
+
+    def test_profile_update_is_deferred(self, update_profile):
+        profile = {'id': '1', 'first_name': 'First'}
+        with mock.patch.object(UserFactory, 'create_profile_object') as create:
+            UserFactory()._product_user(None, profile)
+        self.assertFalse(create.called)
+        update_profile.delay.assert_called_once_with(1, profile)
+
+    def test_fresh_profile_is_not_updated_again(self, update_profile):
+        profile = {'id': '1', 'first_name': 'First'}
+        UserFactory()._product_user(None, profile)
+        UserFactory()._product_user(None, profile)
+        self.assertEqual(1, update_profile.delay.call_count)
+
+    def test_scheduling_after_transaction(self, update_profile):
+        profile = {'id': '1', 'first_name': 'First'}
+        atomic = transaction.atomic
+
+        @contextlib.contextmanager
+        def check_atomic(*args, **kwargs):
+            with atomic(*args, **kwargs):
+                yield
+            self.assertFalse(update_profile.delay.called)
+
+        with mock.patch.object(transaction, 'atomic', check_atomic):
+            UserFactory()._product_user(None, profile)
+        self.assertTrue(update_profile.delay.called)
+
+
+@mock.patch('facebook_auth.backends.LOGIN_GRAPH_BATCH', True)
+@mock.patch('facebook_auth.models.insert_extended_token')
+@mock.patch('facebook_auth.models.FacebookTokenManager.debug_all_user_tokens', mock.Mock())
+@mock.patch('facebook_auth.facepy_wrapper.utils.get_graph')
+class LoginGraphBatchTest(test.TestCase):
+    def get_user(self):
+        with self.settings(REQUEST_LONG_LIVED_ACCESS_TOKEN=True):
+            return UserFactory().get_user('short')
+
+    def get_tokens(self):
+        return set(models.UserToken.objects.filter(provider_user_id='123')
+                   .values_list('token', flat=True))
+
+    def test_profile_and_exchange_in_one_batch(self, get_graph,
+                                               insert_extended_token):
+        graph = get_graph.return_value
+        graph.batch.return_value = iter([
+            {'id': '123'},
+            {'access_token': 'long', 'expires_in': 5184000}])
+        user = self.get_user()
+        self.assertEqual(123, user.user_id)
+        self.assertFalse(graph.get.called)
+        self.assertFalse(insert_extended_token.delay.called)
+        self.assertEqual({'short', 'long'}, self.get_tokens())
+
+    def test_failed_exchange(self, get_graph, insert_extended_token):
+        get_graph.return_value.batch.return_value = iter([
+            {'id': '123'}, FacebookError('msg', 1)])
+        self.get_user()
+        self.assertEqual({'short'}, self.get_tokens())
+        insert_extended_token.delay.assert_called_once_with('short', '123')
+
+    def test_empty_batch_items(self, get_graph, insert_extended_token):
+        graph = get_graph.return_value
+        graph.batch.return_value = iter([None, None])
+        graph.get.return_value = {'id': '123'}
+        user = self.get_user()
+        self.assertEqual(123, user.user_id)
+        insert_extended_token.delay.assert_called_once_with('short', '123')
+
+    def test_empty_exchange_item(self, get_graph, insert_extended_token):
+        get_graph.return_value.batch.return_value = iter([{'id': '123'},
+                                                          None])
+        self.get_user()
+        self.assertEqual({'short'}, self.get_tokens())
+        self.assertFalse(get_graph.return_value.get.called)
+
+    def test_fallback_to_separate_requests(self, get_graph,
+                                           insert_extended_token):
+        graph = get_graph.return_value
+        graph.batch.side_effect = FacebookError('msg', 1)
+        graph.get.return_value = {'id': '123'}
+        user = self.get_user()
+        self.assertEqual(123, user.user_id)
+        insert_extended_token.delay.assert_called_once_with('short', '123')
+
 
-@mock.patch('django.utils.timezone.now')
+@mock.patch('facebook_auth.facepy_wrapper.graph_api.now_ns')
 @mock.patch('facepy.GraphAPI._query')
-@mock.patch('facebook_auth.facepy_wrapper.graph_api.GRAPH_OBSERVER_CLASSES')
 class ObservableGraphApiTest(test.SimpleTestCase):
-    def test_query_failure(self, observers, query, now):
-        now.side_effect = [
-            datetime.datetime(year=1, month=1, day=1, minute=1),
-            datetime.datetime(year=1, month=1, day=1, minute=2),
-        ]
+    def observe_with(self, observer_cls):
+        return mock.patch.object(
+            graph_api, 'GRAPH_OBSERVERS',
+            graph_api.create_graph_observers([observer_cls]))
+
+    def test_query_failure(self, query, now_ns):
+        now_ns.side_effect = [60 * 10 ** 9, 120 * 10 ** 9]
         query.side_effect = FacebookError("msg", 1)
         observer_cls = mock.Mock()
-        observers.__iter__.return_value = [observer_cls]
-        with self.assertRaises(FacebookError):
-            graph_api.ObservableGraphAPI().get('me')
+        with self.observe_with(observer_cls):
+            with self.assertRaises(FacebookError):
+                graph_api.ObservableGraphAPI().get('me')
         observer_cls.return_value.handle_facebook_communication.assert_called_once_with()
         observer_cls.assert_called_once_with(None, None, query.side_effect,
                                              datetime.timedelta(minutes=1))
 
-    def test_query_success_string(self, observers, query, now):
-        now.side_effect = [
-            datetime.datetime(year=1, month=1, day=1, minute=1),
-            datetime.datetime(year=1, month=1, day=1, minute=2),
-        ]
+    def test_query_success_string(self, query, now_ns):
+        now_ns.side_effect = [60 * 10 ** 9, 120 * 10 ** 9]
         query.return_value = 'some string response'
         observer_cls = mock.Mock()
-        observers.__iter__.return_value = [observer_cls]
-        graph_api.ObservableGraphAPI().get('me')
+        with self.observe_with(observer_cls):
+            graph_api.ObservableGraphAPI().get('me')
         observer_cls.return_value.handle_facebook_communication.assert_called_once_with()
         observer_cls.assert_called_once_with(None, None, None,
                                              datetime.timedelta(minutes=1))
 
+    def test_reusable_observer(self, query, now_ns):
+        now_ns.return_value = 0
+
+        class Observer(object):
+            reusable = True
+            observe = mock.Mock()
+
+        with self.observe_with(Observer):
+            graph_api.ObservableGraphAPI().get('me')
+            graph_api.ObservableGraphAPI().get('me')
+        self.assertEqual(2, Observer.observe.call_count)
+
+    def test_queued_dispatch(self, query, now_ns):
+        now_ns.return_value = 0
+        observed = threading.Event()
+        observer_cls = mock.Mock()
+        observer_cls.return_value.handle_facebook_communication.side_effect = (
+            observed.set)
+        dispatcher = graph_api.QueuedDispatcher(10)
+        with self.observe_with(observer_cls):
+            with mock.patch.object(graph_api, 'DISPATCHER', dispatcher):
+                graph_api.ObservableGraphAPI().get('me')
+        self.assertTrue(observed.wait(5))
+
+    def test_handlers_are_per_thread(self, query, now_ns):
+        session = graph_api.ObservableSession(mock.Mock())
+        handlers = mock.Mock()
+        session.set_handlers(handlers)
+        thread = threading.Thread(target=session.request,
+                                  args=('GET', 'url'))
+        thread.start()
+        thread.join()
+        self.assertFalse(handlers.handle_request.called)
+        session.request('GET', 'url')
+        handlers.handle_request.assert_called_once_with('GET', 'url')
+
+
+class GraphSessionTest(test.SimpleTestCase):
+    def test_sharing_session_in_thread(self):
+        first = graph_api.ObservableGraphAPI('token1')
+        second = graph_api.ObservableGraphAPI('token2')
+        self.assertIs(first.session.other_session,
+                      second.session.other_session)
+        self.assertIsNot(first.session, second.session)
+
+    def test_separate_session_per_thread(self):
+        sessions = []
+        thread = threading.Thread(
+            target=lambda: sessions.append(graph_api.get_session()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(graph_api.get_session(), sessions[0])
+
+    def test_new_session_after_fork(self):
+        session = graph_api.get_session()
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertIsNot(session, graph_api.get_session())
+
 
 class GraphObserversTest(test.SimpleTestCase):
     def test_getting_observer_classes(self):
@@ -196,6 +486,29 @@ class UserTokenManagerTest(test.TestCase):
         self.assertRaises(models.UserToken.DoesNotExist,
                           manager.get_access_token, '123')
 
+    @mock.patch('facebook_auth.models.FacebookTokenManager.debug_all_user_tokens', mock.Mock())
+    def test_invalidating_tokens(self):
+        manager = models.UserTokenManager
+        for token in ['abc1', 'abc2', 'abc3']:
+            manager.insert_token('123', token, None)
+        with self.assertNumQueries(1):
+            manager.invalidate_tokens(['abc1', 'abc2'])
+        self.assertEqual(['abc3'], list(
+            models.UserToken.objects.filter(deleted=False)
+            .values_list('token', flat=True)))
+
+    @mock.patch('facebook_auth.models.FacebookTokenManager.debug_all_user_tokens', mock.Mock())
+    def test_invalidating_tokens_of_user(self):
+        manager = models.UserTokenManager
+        for token in ['abc1', 'abc2', 'abc3']:
+            manager.insert_token('123', token, None)
+        manager.insert_token('456', 'other', None)
+        with self.assertNumQueries(1):
+            manager.invalidate_tokens(['abc1', 'abc2', 'other'], 123)
+        self.assertEqual(['abc3', 'other'], sorted(
+            models.UserToken.objects.filter(deleted=False)
+            .values_list('token', flat=True)))
+
     @mock.patch('django.utils.timezone.now',
                 return_value=datetime.datetime(1989, 1, 1, tzinfo=pytz.utc))
     @mock.patch('facebook_auth.models.FacebookTokenManager.debug_all_user_tokens', mock.Mock())
@@ -265,12 +578,264 @@ class UserTokenManagerTest(test.TestCase):
         token = manager.get_access_token('555')
         self.assertEqual('WithExpirationDate', token.token)
 
+    @mock.patch('facebook_auth.models.FacebookTokenManager.debug_all_user_tokens', mock.Mock())
+    def test_getting_token_in_single_query(self):
+        models.UserToken.objects.create(
+            provider_user_id='555',
+            token='Expiring',
+            expiration_date=datetime.datetime(4444, 1, 1, tzinfo=pytz.utc),
+        )
+        manager = models.UserTokenManager
+        with self.assertNumQueries(1):
+            token = manager.get_access_token('555')
+        self.assertEqual('Expiring', token.token)
+
+    @mock.patch('facebook_auth.models.FacebookTokenManager.debug_all_user_tokens')
+    def test_bulk_insert(self, debug_all_user_tokens):
+        manager = models.UserTokenManager
+        manager.insert_token('123', 'old', None)
+        debug_all_user_tokens.reset_mock()
+        expiration_date = datetime.datetime(4444, 2, 25, tzinfo=pytz.utc)
+        manager.insert_tokens([
+            ('123', 'old', expiration_date),
+            ('123', 'new123', None),
+            (456, 'new456', expiration_date),
+            ('456', 'new456-2', expiration_date),
+        ])
+        self.assertEqual(4, models.UserToken.objects.count())
+        self.assertEqual(expiration_date,
+                         models.UserToken.objects.get(token='old')
+                         .expiration_date)
+        self.assertEqual('456', models.UserToken.objects.get(token='new456')
+                         .provider_user_id)
+        self.assertEqual(sorted([mock.call('123'), mock.call('456')]),
+                         sorted(debug_all_user_tokens.mock_calls))
+
+    @mock.patch('facebook_auth.models.FacebookTokenManager.debug_all_user_tokens')
+    def test_bulk_insert_of_existing_tokens(self, debug_all_user_tokens):
+        manager = models.UserTokenManager
+        manager.insert_token('123', 'old', None)
+        debug_all_user_tokens.reset_mock()
+        manager.insert_tokens([('123', 'old', None)])
+        self.assertFalse(debug_all_user_tokens.called)
+
+    @mock.patch('facebook_auth.models.FacebookTokenManager.debug_all_user_tokens', mock.Mock())
+    def test_bulk_update_of_expiration_dates(self):
+        manager = models.UserTokenManager
+        for token in ('a', 'b', 'c'):
+            manager.insert_token('123', token, None)
+        dates = [datetime.datetime(4444, 2, day, tzinfo=pytz.utc)
+                 for day in (1, 2)]
+        with test_utils.CaptureQueriesContext(connection) as queries:
+            manager.insert_tokens([('123', 'a', dates[0]),
+                                   ('123', 'b', dates[1]),
+                                   ('123', 'c', None)])
+        updates = [query for query in queries.captured_queries
+                   if query['sql'].startswith('UPDATE')]
+        self.assertEqual(1, len(updates))
+        self.assertEqual(
+            [('a', dates[0]), ('b', dates[1]), ('c', None)],
+            list(models.UserToken.objects.order_by('token')
+                 .values_list('token', 'expiration_date')))
+
     def test_getting_raising_error_on_no_token(self):
         manager = models.UserTokenManager
         self.assertRaises(models.UserToken.DoesNotExist,
                           manager.get_access_token, '555')
 
 
+@mock.patch('facebook_auth.models.FacebookTokenManager.debug_all_user_tokens', mock.Mock())
+class CachedUserTokenManagerTest(test.TestCase):
+    def setUp(self):
+        patcher = mock.patch('facebook_auth.models.TOKEN_CACHE',
+                             token_cache.DjangoTokenCache(local_size=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(cache.clear)
+
+    def insert_token(self, token):
+        models.UserTokenManager.insert_token(
+            '123', token, datetime.datetime(4444, 2, 25, tzinfo=pytz.utc))
+
+    def test_cache_hit(self):
+        self.insert_token('abc123')
+        models.UserTokenManager.get_access_token('123')
+        with self.assertNumQueries(0):
+            token = models.UserTokenManager.get_access_token('123')
+        self.assertEqual('abc123', token.token)
+
+    def test_invalidating_on_insert(self):
+        self.insert_token('abc123')
+        models.UserTokenManager.get_access_token('123')
+        models.UserToken.objects.create(
+            provider_user_id='123', token='WildcardedToken')
+        token = models.UserTokenManager.get_access_token('123')
+        self.assertEqual('WildcardedToken', token.token)
+
+    def test_invalidating_token(self):
+        self.insert_token('abc123')
+        models.UserTokenManager.get_access_token('123')
+        models.UserTokenManager.invalidate_access_token('abc123')
+        self.assertRaises(models.UserToken.DoesNotExist,
+                          models.UserTokenManager.get_access_token, '123')
+
+
+class LocalTokenCacheTest(test.SimpleTestCase):
+    def test_least_recently_used_is_dropped(self):
+        local_cache = token_cache.LocalTokenCache(max_size=2, timeout=60)
+        local_cache.set('1', 'token1')
+        local_cache.set('2', 'token2')
+        local_cache.get('1')
+        local_cache.set('3', 'token3')
+        self.assertEqual('token1', local_cache.get('1'))
+        self.assertIsNone(local_cache.get('2'))
+        self.assertEqual('token3', local_cache.get('3'))
+
+    @mock.patch('time.time')
+    def test_expiration(self, time):
+        local_cache = token_cache.LocalTokenCache(max_size=2, timeout=60)
+        time.return_value = 100
+        local_cache.set('1', 'token1')
+        time.return_value = 161
+        self.assertIsNone(local_cache.get('1'))
+
+
+@mock.patch.object(models.FacebookUser, 'graph', new_callable=mock.PropertyMock)
+class FriendsTest(test.SimpleTestCase):
+    def test_following_pages(self, graph):
+        graph.return_value.get.side_effect = [
+            {'data': [{'id': '1'}, {'id': '2'}],
+             'paging': {'cursors': {'after': 'A'}, 'next': 'url'}},
+            {'data': [{'id': '3'}],
+             'paging': {'cursors': {'after': 'B'}}},
+        ]
+        friends = models.FacebookUser().iter_friends(page_size=2)
+        self.assertEqual(['1', '2', '3'], [f['id'] for f in friends])
+        self.assertEqual([
+            mock.call('me/friends', limit=2),
+            mock.call('me/friends', limit=2, after='A'),
+        ], graph.return_value.get.mock_calls)
+
+    def test_limit(self, graph):
+        graph.return_value.get.side_effect = [
+            {'data': [{'id': '1'}, {'id': '2'}],
+             'paging': {'cursors': {'after': 'A'}, 'next': 'url'}},
+        ]
+        friends = models.FacebookUser().iter_friends(page_size=2, limit=1)
+        self.assertEqual(['1'], [f['id'] for f in friends])
+        self.assertEqual(1, graph.return_value.get.call_count)
+
+    def test_error_response(self, graph):
+        graph.return_value.get.return_value = {'error': {}}
+        self.assertEqual([], models.FacebookUser().friends)
+
+
+@mock.patch('facebook_auth.models.FacebookUser.iter_friends')
+class UpdateAppFriendsTest(test.TestCase):
+    def create_user(self, user_id):
+        return models.FacebookUser.objects.create(
+            user_id=user_id, username=str(user_id))
+
+    def get_friends(self, user):
+        return sorted(user.app_friends.values_list('user_id', flat=True))
+
+    def test_adding_and_removing(self, iter_friends):
+        user = self.create_user(1)
+        kept, removed, added = [self.create_user(i) for i in (2, 3, 4)]
+        user.app_friends.add(kept, removed)
+        iter_friends.return_value = [{'id': '2'}, {'id': '4'}, {'id': '5'}]
+        user.update_app_friends()
+        self.assertEqual([2, 4], self.get_friends(user))
+        self.assertEqual([1], self.get_friends(added))
+        self.assertEqual([], self.get_friends(removed))
+
+    def test_number_of_queries(self, iter_friends):
+        user = self.create_user(1)
+        for i in range(2, 12):
+            self.create_user(i)
+        iter_friends.return_value = [{'id': str(i)} for i in range(2, 12)]
+        with test_utils.CaptureQueriesContext(connection) as queries:
+            user.update_app_friends()
+        self.assertLessEqual(len(queries), 6)
+        self.assertEqual(list(range(2, 12)), self.get_friends(user))
+
+    def test_retrying_after_concurrent_insert(self, iter_friends):
+        user = self.create_user(1)
+        self.create_user(2)
+        iter_friends.return_value = [{'id': '2'}]
+        through = models.FacebookUser.app_friends.through
+        bulk_create = through.objects.bulk_create
+
+        def racing_bulk_create(*args, **kwargs):
+            if racing.call_count == 1:
+                raise IntegrityError
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(through.objects, 'bulk_create',
+                               side_effect=racing_bulk_create) as racing:
+            user.update_app_friends()
+        self.assertEqual(2, racing.call_count)
+        self.assertEqual([2], self.get_friends(user))
+
+
+@mock.patch('facebook_auth.models.FRIENDS_SYNC_BUCKET', mock.Mock())
+@mock.patch('facebook_auth.models.FacebookUser.update_app_friends',
+            autospec=True)
+class UpdateAppFriendsForUsersTest(test.TestCase):
+    def tearDown(self):
+        cache.clear()
+
+    def test_skipping_recently_synced(self, update_app_friends):
+        user = models.FacebookUser.objects.create(user_id=1, username='1')
+        models.update_app_friends_for_users([user.pk])
+        models.update_app_friends_for_users([user.pk])
+        update_app_friends.assert_called_once_with(
+            user, bucket=models.FRIENDS_SYNC_BUCKET)
+
+    def test_failed_sync(self, update_app_friends):
+        update_app_friends.side_effect = models.UserToken.DoesNotExist
+        user = models.FacebookUser.objects.create(user_id=1, username='1')
+        models.update_app_friends_for_users([user.pk])
+
+    def test_conflicting_sync_does_not_stop_chunk(self, update_app_friends):
+        update_app_friends.side_effect = [IntegrityError, None]
+        users = [models.FacebookUser.objects.create(user_id=i, username=str(i))
+                 for i in range(2)]
+        models.update_app_friends_for_users([user.pk for user in users])
+        self.assertEqual(2, update_app_friends.call_count)
+        for user in users:
+            self.assertTrue(cache.get(models._get_friends_synced_key(user.pk)))
+
+    @mock.patch('facebook_auth.models.update_app_friends_for_users')
+    def test_scheduling_in_chunks(self, task, update_app_friends):
+        users = [models.FacebookUser.objects.create(user_id=i, username=str(i))
+                 for i in range(3)]
+        self.assertEqual(3, models.schedule_app_friends_sync(chunk_size=2))
+        self.assertEqual([
+            mock.call.delay([users[0].pk, users[1].pk]),
+            mock.call.delay([users[2].pk]),
+        ], task.mock_calls)
+
+
+class SharedTokenBucketTest(test.SimpleTestCase):
+    def tearDown(self):
+        cache.clear()
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.time')
+    def test_waiting_for_next_second(self, time, sleep):
+        time.return_value = 100.25
+        sleep.side_effect = lambda seconds: setattr(
+            time, 'return_value', time.return_value + seconds)
+        first, second = [utils.SharedTokenBucket('test', rate=2)
+                         for _ in range(2)]
+        first.acquire()
+        second.acquire()
+        self.assertFalse(sleep.called)
+        first.acquire()
+        sleep.assert_called_once_with(0.75)
+
+
 class TestParseFacebookResponse(test.SimpleTestCase):
     def test_without_data(self):
         response = forms.parse_facebook_response({}, '123')
@@ -356,6 +921,56 @@ class TestParseFacebookResponse(test.SimpleTestCase):
         self.assertEqual(response.is_valid, False)
 
 
+class TestParsingResponseFields(test.SimpleTestCase):
+    def parse(self, data):
+        try:
+            response = forms.try_to_parse_facebook_response({'data': data},
+                                                            '123')
+            return response.parsed_data, None
+        except forms.FacebookResponseError as e:
+            return None, sorted(e.errors)
+
+    def get_expires_at(self, timestamp):
+        return datetime.datetime.fromtimestamp(timestamp).replace(
+            tzinfo=pytz.utc)
+
+    def test_valid_responses(self):
+        self.assertEqual(({
+            'token': '123', 'user_id': '123', 'token_is_valid': True,
+            'expires_at': self.get_expires_at(12341234),
+            'scopes': ['email', ''],
+        }, None), self.parse({'expires_at': 12341234, 'is_valid': True,
+                              'scopes': ['email', None], 'user_id': 123}))
+        self.assertEqual(({
+            'token': '123', 'user_id': '123', 'token_is_valid': True,
+            'expires_at': self.get_expires_at(12341234), 'scopes': [],
+        }, None), self.parse({'expires_at': '12341234', 'is_valid': 'foo',
+                              'user_id': '123'}))
+        self.assertEqual(({
+            'token': '123', 'user_id': '1.1', 'token_is_valid': True,
+            'expires_at': self.get_expires_at(0), 'scopes': [],
+        }, None), self.parse({'expires_at': 0, 'is_valid': True,
+                              'user_id': 1.1, 'scopes': {}}))
+        self.assertEqual([], self.parse({
+            'expires_at': 12341234, 'is_valid': True,
+            'scopes': ['', None], 'user_id': '123'})[0]['scopes'])
+
+    def test_invalid_responses(self):
+        self.assertEqual((None, ['token_is_valid']), self.parse({
+            'expires_at': 12341234, 'is_valid': 'false', 'user_id': '123'}))
+        self.assertEqual((None, ['scopes']), self.parse({
+            'expires_at': 12341234, 'is_valid': True, 'scopes': 'email',
+            'user_id': '123'}))
+        self.assertEqual(
+            (None, ['expires_at', 'token_is_valid', 'user_id']),
+            self.parse({'expires_at': {}, 'is_valid': [], 'user_id': ''}))
+
+    def test_invalid_timestamp(self):
+        response = forms.parse_facebook_response({'data': {
+            'expires_at': 'soon', 'is_valid': True, 'user_id': '123'}}, '123')
+        self.assertEqual(['expires_at'], list(response.errors))
+
+
 class TestDebugAllTokensForUser(test.TestCase):
     def tearDown(self):
         cache.clear()
@@ -382,6 +997,49 @@ class TestDebugAllTokensForUser(test.TestCase):
         self.assertRaises(models.UserToken.DoesNotExist,
                           token_manager.get_access_token, '123')
 
+    @mock.patch('facebook_auth.models.BATCH_DEBUG_TOKENS', True)
+    @mock.patch.object(models, 'FacebookTokenManager')
+    def test_batch_negative_scenario(self, FacebookTokenManager):
+        manager = FacebookTokenManager.return_value
+        manager.debug_tokens.return_value = [
+            ('token1212', models.TokenDebugException())]
+        token_manager = models.UserTokenManager()
+        token_manager.insert_token('123', 'token1212', "2014-02-02")
+        models.debug_all_tokens_for_user('123')
+        manager.debug_tokens.assert_called_once_with(['token1212'])
+        self.assertFalse(manager.debug_token.called)
+        self.assertRaises(models.UserToken.DoesNotExist,
+                          token_manager.get_access_token, '123')
+
+    @mock.patch('facebook_auth.models.BATCH_DEBUG_TOKENS', True)
+    @mock.patch('facebook_auth.utils.get_application_graph')
+    def test_batch_errors_keep_tokens(self, get_application_graph):
+        token_manager = models.UserTokenManager()
+        token_manager.insert_token('123', 'token1212', "2014-02-02")
+        graph = get_application_graph.return_value
+        for response in [FacebookError('msg', 613), None]:
+            graph.batch.return_value = iter([response])
+            with self.assertRaises(Exception):
+                models.debug_all_tokens_for_user('123')
+            self.assertFalse(models.UserToken.objects.get(
+                token='token1212').deleted)
+
+    @mock.patch('facebook_auth.models.debug_all_tokens_for_user.apply_async')
+    @mock.patch.object(usage.GOVERNOR, 'get_retry_after', return_value=60)
+    @mock.patch.object(models, 'FacebookTokenManager')
+    def test_postponing_on_high_usage(self, FacebookTokenManager, _,
+                                      apply_async):
+        models.debug_all_tokens_for_user('123')
+        self.assertFalse(FacebookTokenManager.called)
+        apply_async.assert_called_once_with(args=['123'], countdown=60)
+
+    @mock.patch('facebook_auth.models.debug_all_tokens_for_user.retry')
+    @mock.patch('facebook_auth.models.debug_user_tokens',
+                return_value=models.TOKENS_RETRY)
+    def test_retrying_when_new_best_token_arrived(self, _, retry):
+        models.debug_all_tokens_for_user('123')
+        retry.assert_called_once_with(args=['123'], countdown=45)
+
     @mock.patch('facebook_auth.models.debug_all_tokens_for_user')
     def test_caching_for_single_user(self, debug_all_tokens_for_user):
         models.FacebookTokenManager.debug_all_user_tokens(1)
@@ -400,6 +1058,486 @@ class TestDebugAllTokensForUser(test.TestCase):
         ], debug_all_tokens_for_user.mock_calls)
 
 
+class ApplicationTokenCacheTest(test.SimpleTestCase):
+    def setUp(self):
+        self.token_cache = utils.ApplicationTokenCache(60)
+
+    def tearDown(self):
+        cache.clear()
+
+    @mock.patch('facebook_auth.facepy_wrapper.utils.get_application_access_token')
+    def test_token_is_fetched_once(self, get_application_access_token):
+        get_application_access_token.return_value = 'app-token'
+        self.assertEqual('app-token',
+                         self.token_cache.get('1', 'secret', '2.1'))
+        self.assertEqual('app-token',
+                         self.token_cache.get('1', 'secret', '2.1'))
+        get_application_access_token.assert_called_once_with(
+            '1', 'secret', version='2.1')
+
+    @mock.patch('facebook_auth.facepy_wrapper.utils.get_application_access_token')
+    def test_token_is_shared_by_cache(self, get_application_access_token):
+        get_application_access_token.return_value = 'app-token'
+        self.token_cache.get('1', 'secret', '2.1')
+        other_process_cache = utils.ApplicationTokenCache(60)
+        self.assertEqual('app-token',
+                         other_process_cache.get('1', 'secret', '2.1'))
+        self.assertEqual(1, get_application_access_token.call_count)
+
+    @mock.patch('facebook_auth.facepy_wrapper.utils.get_application_access_token')
+    def test_token_per_version(self, get_application_access_token):
+        get_application_access_token.side_effect = ['token21', 'token22']
+        self.assertEqual('token21',
+                         self.token_cache.get('1', 'secret', '2.1'))
+        self.assertEqual('token22',
+                         self.token_cache.get('1', 'secret', '2.2'))
+
+    @mock.patch('facebook_auth.facepy_wrapper.utils.get_application_access_token')
+    @mock.patch('facebook_auth.utils.APPLICATION_TOKEN_FROM_SECRET', True)
+    def test_token_from_secret(self, get_application_access_token):
+        self.assertEqual('1|secret',
+                         self.token_cache.get('1', 'secret', '2.1'))
+        self.assertFalse(get_application_access_token.called)
+
+
+@mock.patch('facebook_auth.utils.get_application_graph')
+class DebugTokensTest(test.TestCase):
+    def test_batch_results(self, get_application_graph):
+        graph = get_application_graph.return_value
+        graph.batch.return_value = iter([
+            {'data': {'expires_at': 12341234, 'is_valid': True,
+                      'user_id': '123'}},
+            FacebookError('msg', 190),
+            {'data': {'is_valid': False}},
+        ])
+        results = models.FacebookTokenManager().debug_tokens(
+            ['valid', 'error', 'invalid'])
+        self.assertEqual(['valid', 'error', 'invalid'],
+                         [token for token, _ in results])
+        self.assertEqual('123', results[0][1].user)
+        self.assertIsInstance(results[1][1], models.TokenDebugException)
+        self.assertIsInstance(results[2][1], models.TokenDebugException)
+        requests = graph.batch.call_args[0][0]
+        self.assertEqual({'method': 'GET',
+                          'relative_url': 'debug_token?input_token=valid'},
+                         requests[0])
+
+    def test_batch_size(self, get_application_graph):
+        graph = get_application_graph.return_value
+        graph.batch.side_effect = lambda requests: [
+            {'data': {'is_valid': False}} for _ in requests]
+        tokens = ['token%d' % i for i in range(120)]
+        results = models.FacebookTokenManager().debug_tokens(tokens)
+        self.assertEqual(120, len(results))
+        self.assertEqual([50, 50, 20], [len(call[0][0]) for call
+                                        in graph.batch.call_args_list])
+
+    def test_batch_errors_are_raised(self, get_application_graph):
+        graph = get_application_graph.return_value
+        for response in [FacebookError('msg', 4), None]:
+            graph.batch.return_value = iter([response])
+            with self.assertRaises(Exception) as context:
+                models.FacebookTokenManager().debug_tokens(['token'])
+            self.assertNotIsInstance(context.exception,
+                                     models.TokenDebugException)
+
+
+class RetryPolicyTest(test.SimpleTestCase):
+    def setUp(self):
+        self.policy = utils.RetryPolicy(max_tries=3, base_delay=1,
+                                        max_delay=4, deadline=10)
+
+    def test_not_retryable_error(self):
+        error = FacebookError('msg', 190)
+        self.assertIsNone(self.policy.get_retry_delay(0, error, 0))
+
+    @mock.patch('random.uniform', lambda a, b: b)
+    def test_exponential_backoff(self):
+        error = FacebookError('msg', 1)
+        self.assertEqual(1, self.policy.get_retry_delay(0, error, 0))
+        self.assertEqual(2, self.policy.get_retry_delay(1, error, 0))
+        self.assertIsNone(self.policy.get_retry_delay(2, error, 0))
+
+    def test_throttling_waits_max_delay(self):
+        error = FacebookError('msg', 4)
+        self.assertEqual(4, self.policy.get_retry_delay(0, error, 0))
+
+    def test_deadline(self):
+        error = FacebookError('msg', 4)
+        self.assertIsNone(self.policy.get_retry_delay(0, error, 7))
+
+    def test_honouring_business_usage(self):
+        error = FacebookError('msg', 613)
+        headers = {'X-Business-Use-Case-Usage': json.dumps({
+            '1': [{'call_count': 100, 'estimated_time_to_regain_access': 1}]
+        })}
+        self.policy.deadline = None
+        self.assertEqual(60, self.policy.get_retry_delay(0, error, 0,
+                                                         headers))
+
+    @mock.patch('time.sleep')
+    def test_retrying_in_get_from_graph_api(self, sleep):
+        graph = mock.Mock()
+        graph.get.side_effect = [FacebookError('msg', 17), {'id': '1'}]
+        self.assertEqual({'id': '1'}, utils.get_from_graph_api(
+            graph, 'me', retry_policy=self.policy))
+        sleep.assert_called_once_with(4)
+
+
+class UsageTest(test.SimpleTestCase):
+    def test_app_usage(self):
+        headers = {'X-App-Usage': json.dumps(
+            {'call_count': 28, 'total_time': 45, 'total_cputime': 3})}
+        self.assertEqual(45, usage.get_usage(headers).percentage)
+
+    def test_invalid_header(self):
+        self.assertEqual(usage.NO_USAGE,
+                         usage.get_usage({'X-App-Usage': 'nope'}))
+
+
+@mock.patch('time.time', mock.Mock(return_value=1000))
+class UsageGovernorTest(test.SimpleTestCase):
+    def setUp(self):
+        self.governor = usage.UsageGovernor(
+            limits={usage.PRIORITY_LOW: 75}, timeout=60)
+
+    def tearDown(self):
+        cache.clear()
+
+    def record_usage(self, percentage):
+        self.governor.record({'X-App-Usage': json.dumps(
+            {'call_count': percentage})})
+
+    def test_below_limit(self):
+        self.record_usage(50)
+        self.governor.acquire(usage.PRIORITY_LOW)
+
+    def test_shedding_low_priority(self):
+        self.record_usage(80)
+        with self.assertRaises(usage.UsageLimitExceeded) as context:
+            self.governor.acquire(usage.PRIORITY_LOW)
+        self.assertEqual(60, context.exception.retry_after)
+
+    def test_high_priority_is_not_limited(self):
+        self.record_usage(100)
+        self.governor.acquire(usage.PRIORITY_HIGH)
+
+    @mock.patch('time.sleep')
+    def test_waiting_for_regained_access(self, sleep):
+        self.governor.record({'X-Business-Use-Case-Usage': json.dumps({
+            '1': [{'call_count': 100, 'estimated_time_to_regain_access': 1}]
+        })})
+        self.governor.acquire(usage.PRIORITY_LOW, max_wait=120,
+                              business_id='1')
+        sleep.assert_called_once_with(60)
+
+    def test_business_usage_does_not_limit_app(self):
+        self.governor.record({'X-Business-Use-Case-Usage': json.dumps({
+            '1': [{'call_count': 100}]})})
+        self.governor.acquire(usage.PRIORITY_LOW)
+        with self.assertRaises(usage.UsageLimitExceeded):
+            self.governor.acquire(usage.PRIORITY_LOW, business_id='1')
+
+    def test_recording_zero_usage(self):
+        self.record_usage(80)
+        self.record_usage(0)
+        self.governor.acquire(usage.PRIORITY_LOW)
+
+    def test_ignoring_missing_headers(self):
+        self.record_usage(80)
+        self.governor.record({})
+        with self.assertRaises(usage.UsageLimitExceeded):
+            self.governor.acquire(usage.PRIORITY_LOW)
+
+    def test_limiting_writes_below_limit(self):
+        self.record_usage(10)
+        with mock.patch('facebook_auth.facepy_wrapper.usage.cache') as cache_:
+            self.record_usage(20)
+            self.assertFalse(cache_.set.called)
+            self.record_usage(80)
+            self.assertTrue(cache_.set.called)
+
+    @mock.patch('time.time')
+    def test_writing_after_record_interval(self, time_):
+        time_.return_value = 1000
+        self.record_usage(10)
+        time_.return_value = 1000 + self.governor.record_interval
+        self.record_usage(20)
+        self.assertEqual(20, self.governor.get_usage().percentage)
+
+
+try:
+    import asyncio
+    import aiohttp
+    from facebook_auth import async_utils
+    from facebook_auth.facepy_wrapper import async_graph_api
+except (ImportError, SyntaxError):
+    async_graph_api = None
+
+
+@unittest.skipIf(async_graph_api is None, 'aiohttp is not installed')
+class AsyncObservableGraphAPITest(test.SimpleTestCase):
+    def test_url(self):
+        graph = async_graph_api.AsyncObservableGraphAPI(version='2.1')
+        self.assertEqual('https://graph.facebook.com/v2.1/me',
+                         graph._get_url('/me'))
+
+    def test_preparing_data(self):
+        graph = async_graph_api.AsyncObservableGraphAPI(
+            'token', appsecret='secret')
+        data = graph._prepare_data({'ids': [1, 2], 'limit': 5,
+                                    'summary': True, 'after': None})
+        self.assertEqual('[1, 2]', data['ids'])
+        self.assertEqual('5', data['limit'])
+        self.assertEqual('true', data['summary'])
+        self.assertNotIn('after', data)
+        self.assertEqual('token', data['access_token'])
+        self.assertIn('appsecret_proof', data)
+
+
+@unittest.skipIf(async_graph_api is None or
+                 not hasattr(mock, 'AsyncMock'),
+                 'aiohttp or AsyncMock is not available')
+class AsyncObservableGraphAPIQueryTest(test.SimpleTestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.session = mock.MagicMock()
+        self.graph = async_graph_api.AsyncObservableGraphAPI(
+            'token', session=self.session)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def respond(self, *bodies):
+        responses = []
+        for body in bodies:
+            response = mock.MagicMock(headers={})
+            response.__aenter__.return_value = response
+            response.text = mock.AsyncMock(return_value=json.dumps(body))
+            responses.append(response)
+        self.session.request.side_effect = responses
+
+    def run_query(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_error_mapping_and_observers(self):
+        self.respond({'error': {'message': 'msg', 'code': 190,
+                                'type': 'OAuthException'}})
+        observed = threading.Event()
+        recorded = []
+        observer = mock.Mock()
+        observer.observe.side_effect = lambda *args: observed.set()
+        with mock.patch.object(graph_api, 'GRAPH_OBSERVERS', [observer]), \
+                mock.patch.object(usage.GOVERNOR, 'record') as record:
+            record.side_effect = lambda headers: recorded.append(
+                threading.current_thread())
+            with self.assertRaises(FacebookError) as context:
+                self.run_query(self.graph.get('me'))
+            self.assertTrue(observed.wait(5))
+        self.assertEqual(190, context.exception.code)
+        self.assertIs(context.exception, observer.observe.call_args[0][2])
+        self.assertEqual(1, len(recorded))
+        self.assertIsNot(threading.current_thread(), recorded[0])
+
+    def test_connection_error(self):
+        self.session.request.side_effect = aiohttp.ClientError
+        with self.assertRaises(async_graph_api.exceptions.HTTPError):
+            self.run_query(self.graph.get('me'))
+
+    def test_batch(self):
+        self.respond([
+            None,
+            {'code': 400, 'body': json.dumps({'error': {
+                'message': 'msg', 'code': 4, 'type': 'OAuthException'}})},
+            {'code': 200, 'body': json.dumps({'id': '1'})},
+        ])
+        results = self.run_query(self.graph.batch([
+            {'method': 'GET', 'relative_url': 'me'}] * 3))
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], FacebookError)
+        self.assertEqual({'id': '1'}, results[2])
+
+    def test_get_from_graph_api_retries(self):
+        graph = mock.Mock(last_response=None)
+        graph.get = mock.AsyncMock(side_effect=[FacebookError('msg', 1),
+                                                {'id': '1'}])
+        with mock.patch('asyncio.sleep', mock.AsyncMock()) as sleep:
+            result = self.run_query(async_utils.get_from_graph_api(
+                graph, 'me'))
+        self.assertEqual({'id': '1'}, result)
+        self.assertEqual(1, sleep.await_count)
+
+
+@mock.patch('facebook_auth.models.FacebookTokenManager.debug_all_user_tokens', mock.Mock())
+@mock.patch('facebook_auth.models.debug_all_tokens_for_user')
+class DebugUserTokensCommandTest(test.TestCase):
+    def setUp(self):
+        for user_id, token in [('1', 'a'), ('1', 'b'), ('2', 'c'),
+                               ('3', 'd')]:
+            models.UserToken.objects.create(provider_user_id=user_id,
+                                            token=token)
+
+    def call_command(self, **options):
+        management.call_command('debug_user_tokens', stdout=six.StringIO(),
+                                **options)
+
+    def test_enqueuing_users_in_chunks(self, task):
+        self.call_command(chunk_size=2)
+        self.assertEqual([mock.call.delay('1'), mock.call.delay('2'),
+                          mock.call.delay('3')], task.mock_calls)
+
+    @mock.patch('facebook_auth.models.debug_user_tokens')
+    def test_workers(self, debug_user_tokens, task):
+        debug_user_tokens.side_effect = [models.TOKENS_DEBUGGED, Exception,
+                                         models.TOKENS_DEBUGGED]
+        self.call_command(workers=2)
+        self.assertEqual(['1', '2', '3'], sorted(
+            call[0][0] for call in debug_user_tokens.call_args_list))
+        self.assertFalse(task.mock_calls)
+
+    @mock.patch('time.sleep')
+    @mock.patch.object(usage.GOVERNOR, 'get_retry_after',
+                       mock.Mock(return_value=12.5))
+    @mock.patch('facebook_auth.models.debug_user_tokens')
+    def test_workers_requeueing(self, debug_user_tokens, sleep, task):
+        results = {'1': [models.TOKENS_RETRY, models.TOKENS_DEBUGGED],
+                   '2': [models.TOKENS_POSTPONED, models.TOKENS_DEBUGGED],
+                   '3': [models.TOKENS_DEBUGGED]}
+        debug_user_tokens.side_effect = (
+            lambda user_id: results[user_id].pop(0))
+        self.call_command(workers=2)
+        self.assertEqual({'1': [], '2': [], '3': []}, results)
+        # Pool threads sleep too, so only waits for the governor count.
+        self.assertEqual(1, sleep.call_args_list.count(mock.call(12.5)))
+
+    def test_resuming_from_checkpoint(self, task):
+        with tempfile.NamedTemporaryFile('w', delete=False) as checkpoint:
+            checkpoint.write('1')
+        self.addCleanup(os.remove, checkpoint.name)
+        self.call_command(checkpoint=checkpoint.name)
+        self.assertEqual([mock.call.delay('2'), mock.call.delay('3')],
+                         task.mock_calls)
+        with open(checkpoint.name) as f:
+            self.assertEqual('3', f.read())
+
+
+@mock.patch('facebook_auth.models.FacebookTokenManager.debug_all_user_tokens', mock.Mock())
+@mock.patch('facebook_auth.models.insert_extended_token')
+class RefreshExpiringTokensTest(test.TestCase):
+    def tearDown(self):
+        cache.clear()
+
+    def create_token(self, token, expires_in):
+        models.UserToken.objects.create(
+            provider_user_id='1', token=token,
+            expiration_date=datetime.datetime.now(pytz.utc) + expires_in)
+
+    def test_refreshing_expiring_tokens(self, insert_extended_token):
+        self.create_token('expiring', datetime.timedelta(days=1))
+        self.create_token('expired', -datetime.timedelta(days=1))
+        self.create_token('fresh', datetime.timedelta(days=50))
+        self.assertEqual(1, models.refresh_expiring_tokens())
+        args = insert_extended_token.apply_async.call_args[1]['args']
+        self.assertEqual(['expiring', '1'], args)
+
+    def test_refreshing_token_once_per_period(self, insert_extended_token):
+        self.create_token('expiring', datetime.timedelta(days=1))
+        models.refresh_expiring_tokens()
+        self.assertEqual(0, models.refresh_expiring_tokens())
+        self.assertEqual(1, insert_extended_token.apply_async.call_count)
+
+
+class FakeGraphServerTest(test.SimpleTestCase):
+    def setUp(self):
+        self.app = fake_graph_server.FakeGraph(users=1000, friends=3)
+
+    def call(self, path, query=''):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+                   'QUERY_STRING': query}
+        start_response = mock.Mock()
+        body = self.app(environ, start_response)
+        status = start_response.call_args[0][0]
+        return int(status.split()[0]), json.loads(body[0].decode('utf-8'))
+
+    def test_login_flow(self):
+        _, data = self.call('/v2.1/oauth/access_token', 'code=42')
+        token = data['access_token']
+        _, profile = self.call('/me', 'access_token=' + token)
+        self.assertEqual('42', profile['id'])
+        _, debug = self.call('/debug_token', 'input_token=' + token)
+        response = forms.parse_facebook_response(debug, token)
+        self.assertTrue(response.is_valid)
+        self.assertEqual('42', response.parsed_data['user_id'])
+
+    def test_friends_paging(self):
+        token = fake_graph_server.FakeGraph._make_token('1')
+        _, page = self.call('/me/friends', 'limit=2&access_token=' + token)
+        self.assertEqual(2, len(page['data']))
+        _, page = self.call('/me/friends', 'limit=2&access_token=%s&after=%s'
+                            % (token, page['paging']['cursors']['after']))
+        self.assertEqual(1, len(page['data']))
+        self.assertNotIn('next', page['paging'])
+
+    def test_throttling(self):
+        self.app.throttle_rate = 1
+        self.app.throttle_codes = (613,)
+        status, data = self.call('/me')
+        self.assertEqual(403, status)
+        self.assertEqual(613, data['error']['code'])
+
+
+class MetricsObserverTest(test.SimpleTestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        patcher = mock.patch.object(metrics, 'REGISTRY', self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def observe(self, url, response=None, error=None, seconds=0.2):
+        request = graph_api.RequestInfo('GET', url)
+        metrics.MetricsObserver().observe(
+            request, response, error, datetime.timedelta(seconds=seconds))
+
+    def test_normalizing_endpoint(self):
+        self.assertEqual('/{id}/friends', metrics.normalize_endpoint(
+            'https://graph.facebook.com/v2.1/1234/friends?limit=5'))
+        self.assertEqual('/me', metrics.normalize_endpoint('me?fields=id'))
+
+    def test_recording(self):
+        response = mock.Mock(status_code=200,
+                             headers={'Content-Length': '120'})
+        self.observe('https://graph.facebook.com/v2.1/me', response)
+        self.observe('https://graph.facebook.com/v2.1/me',
+                     error=FacebookError('msg', 17), seconds=3)
+        snapshot = self.registry.snapshot()
+        self.assertEqual(2, snapshot['latency']['/me']['count'])
+        self.assertEqual({'/me 17': 1}, snapshot['errors'])
+        self.assertEqual({'/me': 120}, snapshot['bytes'])
+
+    def test_prometheus_format(self):
+        self.observe('https://graph.facebook.com/v2.1/me', seconds=0.07)
+        self.registry.record_retry('/me', 1)
+        text = metrics.PrometheusExporter().render(self.registry)
+        self.assertIn('facebook_graph_request_seconds_bucket'
+                      '{endpoint="/me",le="0.05"} 0', text)
+        self.assertIn('facebook_graph_request_seconds_bucket'
+                      '{endpoint="/me",le="0.1"} 1', text)
+        self.assertIn('facebook_graph_retries_total'
+                      '{code="1",endpoint="/me"} 1', text)
+
+    @mock.patch.object(metrics, '_exporters', None)
+    @mock.patch.object(metrics, 'FACEBOOK_GRAPH_METRICS_EXPORTERS',
+                       [MOCK_CLASS_NAME])
+    def test_exporters_loaded_on_first_communication(self):
+        self.observe('https://graph.facebook.com/v2.1/me')
+        self.observe('https://graph.facebook.com/v2.1/me')
+        exporters = metrics.get_exporters()
+        self.assertEqual(1, len(exporters))
+        self.assertEqual(2, exporters[0].handle.call_count)
+
+
 class TestNextUrl(test.TestCase):
     def test_invalid_next(self):
         with self.assertRaises(utils.InvalidNextUrl):
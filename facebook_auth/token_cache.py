@@ -0,0 +1,117 @@
+import collections
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from facebook_auth.facepy_wrapper.graph_api import get_class
+
+FACEBOOK_AUTH_TOKEN_CACHE = getattr(settings, 'FACEBOOK_AUTH_TOKEN_CACHE',
+                                    'facebook_auth.token_cache.TokenCache')
+TOKEN_CACHE_TIMEOUT = getattr(settings, 'FACEBOOK_AUTH_TOKEN_CACHE_TIMEOUT',
+                              5 * 60)
+TOKEN_CACHE_LOCAL_SIZE = getattr(
+    settings, 'FACEBOOK_AUTH_TOKEN_CACHE_LOCAL_SIZE', 0)
+TOKEN_CACHE_LOCAL_TIMEOUT = getattr(
+    settings, 'FACEBOOK_AUTH_TOKEN_CACHE_LOCAL_TIMEOUT', 5)
+
+
+class TokenCache(object):
+    """Cache of best tokens per provider user id which caches nothing.
+
+    Subclasses which store tokens set `caches = True`, so callers know
+    deleting tokens from them is needed.
+    """
+    caches = False
+
+    def get(self, provider_user_id):
+        return None
+
+    def set(self, provider_user_id, token, timeout=None):
+        pass
+
+    def delete(self, provider_user_id):
+        pass
+
+
+class LocalTokenCache(TokenCache):
+    """In-process LRU cache with expiration.
+
+    Deleting is visible only in the current process, so keep the timeout
+    short.
+    """
+    caches = True
+
+    def __init__(self, max_size=TOKEN_CACHE_LOCAL_SIZE,
+                 timeout=TOKEN_CACHE_LOCAL_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, provider_user_id):
+        key = str(provider_user_id)
+        with self._lock:
+            token, valid_until = self._items.pop(key, (None, 0))
+            if valid_until > time.time():
+                self._items[key] = (token, valid_until)
+                return token
+        return None
+
+    def set(self, provider_user_id, token, timeout=None):
+        if self.max_size <= 0:
+            return
+        timeout = self.timeout if timeout is None else min(timeout,
+                                                           self.timeout)
+        key = str(provider_user_id)
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (token, time.time() + timeout)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, provider_user_id):
+        with self._lock:
+            self._items.pop(str(provider_user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class DjangoTokenCache(TokenCache):
+    """Django cache backed token cache with optional LocalTokenCache layer."""
+    caches = True
+    cache_key = 'facebook_auth_best_token-{}'
+
+    def __init__(self, timeout=TOKEN_CACHE_TIMEOUT,
+                 local_size=TOKEN_CACHE_LOCAL_SIZE,
+                 local_timeout=TOKEN_CACHE_LOCAL_TIMEOUT):
+        self.timeout = timeout
+        self.local = LocalTokenCache(local_size, local_timeout)
+
+    def get(self, provider_user_id):
+        token = self.local.get(provider_user_id)
+        if token is None:
+            token = cache.get(self._get_key(provider_user_id))
+            if token is not None:
+                self.local.set(provider_user_id, token)
+        return token
+
+    def set(self, provider_user_id, token, timeout=None):
+        timeout = self.timeout if timeout is None else min(timeout,
+                                                           self.timeout)
+        cache.set(self._get_key(provider_user_id), token, timeout)
+        self.local.set(provider_user_id, token, timeout)
+
+    def delete(self, provider_user_id):
+        cache.delete(self._get_key(provider_user_id))
+        self.local.delete(provider_user_id)
+
+    def _get_key(self, provider_user_id):
+        return self.cache_key.format(provider_user_id)
+
+
+def get_token_cache(class_name=FACEBOOK_AUTH_TOKEN_CACHE):
+    return get_class(class_name)()
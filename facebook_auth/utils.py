@@ -1,8 +1,14 @@
+import itertools
 import json
+import random
+import threading
+import time
 try:
+    from collections.abc import Mapping
     from urllib.parse import urljoin
     from urllib.parse import urlencode
 except ImportError:
+    from collections import Mapping
     from urlparse import urljoin
     from urllib import urlencode
 
@@ -12,15 +18,56 @@ from django.utils import timezone
 
 from django.conf import settings
 from django.core import signing
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.utils import encoding
 
+from . facepy_wrapper import usage
 from . facepy_wrapper import utils
 
-GRAPH_MAX_TRIES = 3
+GRAPH_MAX_TRIES = getattr(settings, 'FACEBOOK_AUTH_GRAPH_MAX_TRIES', 3)
+GRAPH_RETRY_BASE_DELAY = getattr(
+    settings, 'FACEBOOK_AUTH_GRAPH_RETRY_BASE_DELAY', 0.2)
+GRAPH_RETRY_MAX_DELAY = getattr(
+    settings, 'FACEBOOK_AUTH_GRAPH_RETRY_MAX_DELAY', 5)
+GRAPH_RETRY_DEADLINE = getattr(
+    settings, 'FACEBOOK_AUTH_GRAPH_RETRY_DEADLINE', 15)
 FACEBOOK_TIMEOUT = getattr(settings, 'FACEBOOK_AUTH_BACKEND_FACEBOOK_TIMEOUT',
                            timezone.timedelta(seconds=20).total_seconds())
 FACEBOOK_API_VERSION = getattr(settings, 'FACEBOOK_API_VERSION', '2.1')
+APPLICATION_TOKEN_TIMEOUT = getattr(
+    settings, 'FACEBOOK_AUTH_APPLICATION_TOKEN_TIMEOUT',
+    timezone.timedelta(hours=1).total_seconds())
+APPLICATION_TOKEN_FROM_SECRET = getattr(
+    settings, 'FACEBOOK_AUTH_APPLICATION_TOKEN_FROM_SECRET', False)
+
+
+class SharedTokenBucket(object):
+    """Allows `rate` calls per second in all processes sharing Django cache.
+
+    Calls are counted in one second windows kept in cache.
+    """
+    cache_key = 'facebook_auth_rate-{}-{}'
+
+    def __init__(self, name, rate):
+        self.name = name
+        self.rate = rate
+
+    def acquire(self):
+        while True:
+            now = time.time()
+            window = int(now)
+            key = self.cache_key.format(self.name, window)
+            cache.add(key, 0, 2)
+            try:
+                count = cache.incr(key)
+            except ValueError:
+                count = 1
+                cache.set(key, count, 2)
+            if count <= self.rate:
+                return
+            time.sleep(window + 1 - now)
+
 
 class InvalidNextUrl(Exception):
     pass
@@ -60,22 +107,195 @@ def redirect_uri(next, close):
     )
 
 
-def get_from_graph_api(graphAPI, query):
-    for i in range(GRAPH_MAX_TRIES):
+def chunks(items, size):
+    iterator = iter(items)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+class RetryPolicy(object):
+    """Decides if and when a failed Graph API call is retried.
+
+    Delays grow exponentially with full jitter. Throttled calls wait at
+    least until usage headers allow, and no retry starts after the deadline.
+    """
+    TRANSIENT_CODES = (1, 2)
+    THROTTLING_CODES = (4, 17, 32, 613)
+
+    def __init__(self, max_tries=GRAPH_MAX_TRIES,
+                 base_delay=GRAPH_RETRY_BASE_DELAY,
+                 max_delay=GRAPH_RETRY_MAX_DELAY,
+                 deadline=GRAPH_RETRY_DEADLINE):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def is_throttling(self, error):
+        return getattr(error, 'code', None) in self.THROTTLING_CODES
+
+    def is_retryable(self, error):
+        if isinstance(error, facepy.exceptions.HTTPError):
+            return True
+        code = getattr(error, 'code', None)
+        return (code in self.TRANSIENT_CODES or self.is_throttling(error) or
+                bool(getattr(error, 'is_transient', False)))
+
+    def get_delay(self, attempt, error, headers=None):
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        current_usage = usage.get_usage(headers)
+        if current_usage.regain_access_seconds:
+            delay = max(delay, current_usage.regain_access_seconds)
+        elif self.is_throttling(error) or current_usage.percentage >= 100:
+            delay = max(delay, self.max_delay)
+        return delay
+
+    def get_retry_delay(self, attempt, error, elapsed, headers=None):
+        """Return seconds to wait before next try or None to give up."""
+        if attempt >= self.max_tries - 1 or not self.is_retryable(error):
+            return None
+        delay = self.get_delay(attempt, error, headers)
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return None
+        return delay
+
+
+class InteractiveRetryPolicy(RetryPolicy):
+    """Retries transient errors at once and gives up when throttled.
+
+    Meant for calls made while a user waits, where sleeping would tie up
+    the web worker.
+    """
+
+    def is_retryable(self, error):
+        return (super(InteractiveRetryPolicy, self).is_retryable(error) and
+                not self.is_throttling(error))
+
+    def get_delay(self, attempt, error, headers=None):
+        return 0
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+INTERACTIVE_RETRY_POLICY = InteractiveRetryPolicy()
+
+
+def _get_response_headers(graphAPI):
+    session = getattr(graphAPI, 'session', None)
+    headers = getattr(getattr(session, 'last_response', None), 'headers',
+                      None)
+    if isinstance(headers, Mapping):
+        return headers
+    return None
+
+
+def get_from_graph_api(graphAPI, query, retry_policy=None, **params):
+    retry_policy = retry_policy or DEFAULT_RETRY_POLICY
+    start = time.time()
+    attempt = 0
+    while True:
         try:
-            return graphAPI.get(query)
+            return graphAPI.get(query, **params)
         except facepy.FacepyError as e:
-            if i == GRAPH_MAX_TRIES - 1 or getattr(e, 'code', None) != 1:
+            delay = retry_policy.get_retry_delay(
+                attempt, e, time.time() - start,
+                _get_response_headers(graphAPI))
+            if delay is None:
                 raise
+            _record_retry(query, e)
+            time.sleep(delay)
+            attempt += 1
 
 
-def get_application_graph(version=None):
+def _record_retry(query, error):
+    # Imported here to keep utils out of the graph observers import chain.
+    from .facepy_wrapper import metrics
+    metrics.REGISTRY.record_retry(metrics.normalize_endpoint(query),
+                                  getattr(error, 'code', None))
+
+
+class ApplicationTokenCache(object):
+    """Keeps application access tokens per (app id, API version).
+
+    Tokens are held in process memory and in Django cache, so only one
+    thread per process asks Facebook for a token when both are cold.
+    """
+    cache_key = 'facebook_auth_application_token-{}-{}'
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get(self, app_id, app_secret, version):
+        key = (app_id, version)
+        token = self._get_local(key)
+        if token is None:
+            with self._lock:
+                token = self._get_local(key)
+                if token is None:
+                    token = self._get_shared(app_id, app_secret, version)
+                    self._tokens[key] = (token, time.time() + self.timeout)
+        return token
+
+    def clear(self):
+        with self._lock:
+            self._tokens = {}
+
+    def _get_local(self, key):
+        token, valid_until = self._tokens.get(key, (None, 0))
+        if valid_until > time.time():
+            return token
+        return None
+
+    def _get_shared(self, app_id, app_secret, version):
+        key = self.cache_key.format(app_id, version)
+        token = cache.get(key)
+        if token is None:
+            token = self._fetch(app_id, app_secret, version)
+            cache.set(key, token, self.timeout)
+        return token
+
+    @staticmethod
+    def _fetch(app_id, app_secret, version):
+        if APPLICATION_TOKEN_FROM_SECRET:
+            return '{}|{}'.format(app_id, app_secret)
+        return utils.get_application_access_token(app_id, app_secret,
+                                                  version=version)
+
+
+APPLICATION_TOKEN_CACHE = ApplicationTokenCache(APPLICATION_TOKEN_TIMEOUT)
+
+
+def get_application_access_token(version=None):
     version = version or FACEBOOK_API_VERSION
-    token = (facepy.utils
-             .get_application_access_token(settings.FACEBOOK_APP_ID,
-                                           settings.FACEBOOK_APP_SECRET,
-                                           api_version=version))
-    return get_graph(token)
+    return APPLICATION_TOKEN_CACHE.get(settings.FACEBOOK_APP_ID,
+                                       settings.FACEBOOK_APP_SECRET,
+                                       version)
+
+
+def iter_pages_from_graph_api(graphAPI, query, bucket=None, **params):
+    """Yield pages of a cursor-paginated Graph API response lazily.
+
+    If bucket is given, it is acquired before every page request.
+    """
+    params = dict(params)
+    while True:
+        if bucket is not None:
+            bucket.acquire()
+        response = get_from_graph_api(graphAPI, query, **params)
+        yield response
+        paging = response.get('paging', {}) if isinstance(response, dict) else {}
+        after = paging.get('cursors', {}).get('after')
+        if 'next' not in paging or not after:
+            return
+        params['after'] = after
+
+
+def get_application_graph(version=None):
+    return get_graph(get_application_access_token(version))
 
 
 def get_graph(*args, **kwargs):
@@ -91,6 +311,17 @@ def get_long_lived_access_token(access_token):
     )
 
 
+def get_profile_and_long_lived_access_token(access_token, fields):
+    return utils.get_profile_and_long_lived_access_token(
+        access_token=access_token,
+        client_id=settings.FACEBOOK_APP_ID,
+        client_secret=settings.FACEBOOK_APP_SECRET,
+        fields=fields,
+        version=FACEBOOK_API_VERSION,
+        timeout=FACEBOOK_TIMEOUT,
+    )
+
+
 def get_access_token(code=None, redirect_uri=None):
     return utils.get_access_token(
         code=code,
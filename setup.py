@@ -22,6 +22,10 @@ setup(
         'cached_property',
     ),
 
+    extras_require={
+        'async': ['aiohttp>=3.3'],
+    },
+
     packages=[
         'facebook_auth',
         'facebook_auth.migrations',